@@ -1,6 +1,14 @@
+from collections import OrderedDict
+from collections.abc import MutableSet
 from datetime import datetime
+import itertools
+import os
 import psutil
+import random
+import select
 import socket
+import struct
+import threading
 
 
 def address(ip='0.0.0.0:0', port=None):
@@ -29,31 +37,285 @@ def local_ips():
                     yield addr.address
 
 
+MAX_DATAGRAM_SIZE = 65507 # maximum payload of a UDP datagram over IPv4
+
+
+class PeerSet(MutableSet):
+    """
+    Set of peer addresses, which can also be sampled in time proportional to the sample size, rather than to the set size.
+    Addresses are kept in a list as well, along with their position in it:
+    removing an address moves the last one into its position, so that no other address is shifted.
+    """
+
+    def __init__(self, peers=()):
+        self.__items: list[tuple] = []
+        self.__positions: dict[tuple, int] = {}
+        self.__lock = threading.Lock()
+        self.update(peers)
+
+    def __contains__(self, peer):
+        return peer in self.__positions
+
+    def __iter__(self):
+        with self.__lock:
+            return iter(list(self.__items)) # peers may be added while iterating, e.g. by a receiving thread
+
+    def __len__(self):
+        return len(self.__items)
+
+    def add(self, peer):
+        if peer in self.__positions: # the common case, e.g. upon each received datagram
+            return
+        with self.__lock:
+            if peer not in self.__positions:
+                self.__positions[peer] = len(self.__items)
+                self.__items.append(peer)
+
+    def discard(self, peer):
+        with self.__lock:
+            position = self.__positions.pop(peer, None)
+            if position is None:
+                return
+            last = self.__items.pop()
+            if position < len(self.__items):
+                self.__items[position] = last
+                self.__positions[last] = position
+
+    def update(self, peers):
+        for peer in peers:
+            self.add(peer)
+
+    def sample(self, count: int, exclude=None) -> list[tuple]:
+        """Up to `count` distinct random peers, other than `exclude`"""
+        with self.__lock:
+            excluded = 1 if exclude in self.__positions else 0
+            positions = random.sample(range(len(self.__items)), min(count + excluded, len(self.__items)))
+            chosen = [self.__items[i] for i in positions]
+        return [peer for peer in chosen if peer != exclude][:count]
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.__items})'
+
+
+class Dissemination:
+    """
+    How a peer sends messages to all other peers: by default, one unicast datagram per known peer,
+    hence the cost of each broadcast grows with the amount of peers.
+    Subclasses may also wrap outgoing datagrams, and unwrap (or drop, by returning None) incoming ones.
+    Each peer needs its own instance.
+    """
+
+    def setup(self, peer: 'Peer', sock: socket.socket):
+        """Called before the socket of the peer is bound"""
+
+    def joined(self, peer: 'Peer', sock: socket.socket):
+        """Called after the socket of the peer is bound"""
+
+    def send_all(self, peer: 'Peer', message: bytes):
+        for other in tuple(peer.peers):
+            peer.send_to(message, other)
+
+    def received(self, peer: 'Peer', payload: memoryview, sender) -> memoryview | None:
+        return payload
+
+    def close(self):
+        pass
+
+
+class Multicast(Dissemination):
+    """
+    Sends each message once, to an IP multicast group, which the network (or the OS, on loopback) delivers to all members,
+    hence the cost of each broadcast does not depend on the amount of peers.
+    All members must use the same port, which can be shared by several peers on the same machine.
+    Messages are sent from a separate socket, in order for each peer to recognise (and drop) its own messages.
+    """
+
+    def __init__(self, group: str = '239.255.0.1', interface: str = '127.0.0.1', ttl: int = 1):
+        self.group = group
+        self.interface = interface # e.g. the IP address of a LAN interface, rather than loopback
+        self.ttl = ttl # 1 keeps datagrams within the local network
+        self.__sender: socket.socket | None = None
+        self.__source: tuple[str, int] | None = None # address of the sender socket, from which own messages come
+        self.__destination: tuple[str, int] | None = None
+
+    def setup(self, peer, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def joined(self, peer, sock):
+        membership = socket.inet_aton(self.group) + socket.inet_aton(self.interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.__destination = (self.group, sock.getsockname()[1])
+        self.__sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+        self.__sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.interface))
+        self.__sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # other peers may be on the same machine
+        self.__sender.bind((self.interface, 0))
+        self.__source = self.__sender.getsockname()
+
+    def send_all(self, peer, message):
+        assert self.__sender is not None, "Multicast must be given to a peer before use"
+        self.__sender.sendto(message, self.__destination)
+
+    def received(self, peer, payload, sender):
+        return None if sender == self.__source else payload
+
+    def close(self):
+        if self.__sender is not None:
+            self.__sender.close()
+
+
+class Gossip(Dissemination):
+    """
+    Epidemic dissemination: each message is sent to `fanout` random peers only,
+    and each peer receiving it for the first time forwards it to `fanout` random peers of its own, up to `rounds` times.
+    The cost of each broadcast for the sender depends on the fanout only (see `PeerSet.sample`),
+    while the whole group is likely reached in a number of rounds logarithmic in its size,
+    as long as peers know enough other peers (peers get to know each other as they exchange messages).
+    Each message carries a unique ID, in order for peers to drop copies of messages they already received,
+    among the last `memory` ones.
+    """
+
+    HEADER = struct.Struct('>8sQB') # origin nonce, counter, and remaining rounds: the first two are the ID of the message
+
+    def __init__(self, fanout: int = 4, rounds: int = 8, memory: int = 65536):
+        self.fanout = fanout
+        self.rounds = rounds
+        self.__memory = memory
+        self.__nonce = os.urandom(8) # distinguishes messages of different peers
+        self.__counter = itertools.count()
+        self.__seen: OrderedDict[bytes, None] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __forward(self, peer: 'Peer', datagram: bytes, exclude=None):
+        for other in peer.peers.sample(self.fanout, exclude):
+            peer.send_to(datagram, other)
+
+    def __first_time(self, id: bytes) -> bool:
+        with self.__lock:
+            if id in self.__seen:
+                return False
+            self.__seen[id] = None
+            if len(self.__seen) > self.__memory:
+                self.__seen.popitem(last=False)
+            return True
+
+    def send_all(self, peer, message):
+        header = self.HEADER.pack(self.__nonce, next(self.__counter), self.rounds - 1)
+        self.__first_time(header[:-1])
+        self.__forward(peer, header + message)
+
+    def received(self, peer, payload, sender):
+        if len(payload) < self.HEADER.size or not self.__first_time(bytes(payload[:self.HEADER.size - 1])):
+            return None
+        rounds = payload[self.HEADER.size - 1]
+        if rounds > 0:
+            datagram = bytearray(payload)
+            datagram[self.HEADER.size - 1] = rounds - 1
+            self.__forward(peer, bytes(datagram), exclude=sender)
+        return payload[self.HEADER.size:]
+
+
 class Peer:
-    def __init__(self, port, peers=None):
+    def __init__(self, port, peers=None, max_datagram_size: int = MAX_DATAGRAM_SIZE, batch_size: int = 64,
+                 receive_buffer_size: int = None, send_buffer_size: int = None, dissemination: Dissemination = None):
+        """
+        Incoming datagrams larger than `max_datagram_size` bytes are rejected, rather than being silently truncated.
+        Up to `batch_size` datagrams are received at once by `receive_batch`.
+        Kernel buffer sizes can be raised to absorb bursts, at high rates (the OS may cap them).
+        Messages are sent to all peers according to the given dissemination strategy (one datagram per peer, by default).
+        """
         if peers is None:
             peers = set()
-        self.peers = {address(*peer) for peer in peers}
+        self.peers = PeerSet(address(*peer) for peer in peers)
+        self.__dissemination = dissemination or Dissemination()
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if receive_buffer_size:
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer_size)
+        if send_buffer_size:
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer_size)
+        self.__dissemination.setup(self, self.__socket)
         self.__socket.bind(address(port=port))
+        self.__dissemination.joined(self, self.__socket)
+        self.max_datagram_size = max_datagram_size
+        self.__batch_size = max(batch_size, 1)
+        self.__buffer = memoryview(bytearray(max_datagram_size + 1 + _BATCH_ROOM)) # see receive_batch
+        self.__oversized: ValueError | None = None # raised by the next receive_batch
 
     @property
     def local_address(self):
         return self.__socket.getsockname()
+
+    @staticmethod
+    def _encode(message) -> bytes:
+        return message if isinstance(message, bytes) else message.encode()
     
+    def send_to(self, message, peer):
+        self.__socket.sendto(self._encode(message), peer)
+
     def send_all(self, message):
-        if not isinstance(message, bytes):
-            message = message.encode()
-        for peer in self.peers:
-            self.__socket.sendto(message, peer)
+        self.__dissemination.send_all(self, self._encode(message)) # encoded once, no matter how many peers
 
-    def receive(self):
-        message, address = self.__socket.recvfrom(1024)
+    def send_batch(self, messages):
+        for message in messages:
+            self.send_all(message)
+
+    def __receive_into(self, offset: int = 0, flags: int = 0) -> tuple[memoryview | None, tuple, int]:
+        # room for one more byte than allowed, to detect oversized datagrams, which the OS would truncate
+        buffer = self.__buffer[offset:offset + self.max_datagram_size + 1]
+        size, address = self.__socket.recvfrom_into(buffer, len(buffer), flags)
+        if size > self.max_datagram_size:
+            raise ValueError(f"Datagram from {address} exceeds maximum size ({self.max_datagram_size} bytes)")
         self.peers.add(address)
-        return message.decode(), address
+        return self.__dissemination.received(self, buffer[:size], address), address, size
+
+    def receive(self):
+        payload = None
+        while payload is None: # e.g. a copy of a message already received
+            payload, address, _ = self.__receive_into()
+        return str(payload, 'utf-8'), address
+
+    def receive_batch(self, timeout: float = None) -> list[tuple[memoryview, tuple]]:
+        """
+        Waits for one datagram (raising TimeoutError after `timeout` seconds, if given),
+        then drains the ones already waiting in the socket, up to the batch size.
+        Datagrams are received back to back into one preallocated buffer, with room for the largest one plus 64KiB
+        (rather than for the largest one, times the batch size): batches end early if less than the largest one fits.
+        Payloads are views of that buffer, which are only valid until the next call.
+        An oversized datagram ends the batch, which is returned: the error is raised by the next call.
+        """
+        if self.__oversized is not None:
+            error, self.__oversized = self.__oversized, None
+            raise error
+        batch: list[tuple[memoryview, tuple]] = []
+        offset = 0
+        while len(batch) < (self.__batch_size if _DONT_WAIT else 1):
+            if len(self.__buffer) - offset <= self.max_datagram_size:
+                break
+            if not batch and timeout is not None and not select.select([self.__socket], [], [], timeout)[0]:
+                raise TimeoutError(f"No datagram received within {timeout} seconds")
+            try:
+                payload, address, size = self.__receive_into(offset, _DONT_WAIT if batch else 0)
+            except BlockingIOError:
+                break
+            except ValueError as e:
+                if not batch:
+                    raise
+                self.__oversized = e
+                break
+            if payload is not None: # otherwise, its room can be reused
+                batch.append((payload, address))
+                offset += size
+        return batch
 
     def close(self):
         self.__socket.close()
+        self.__dissemination.close()
+
+
+_BATCH_ROOM = 64 * 1024 # room for further datagrams in each batch, beyond one of maximum size
+_DONT_WAIT = getattr(socket, 'MSG_DONTWAIT', 0) # not available on Windows, where batches contain one datagram only
 
 
 if __name__ == '__main__':
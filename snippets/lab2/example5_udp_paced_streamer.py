@@ -0,0 +1,191 @@
+from snippets.lab2 import *
+import struct
+import time
+
+
+_HEADER = struct.Struct('>BQq') # kind, sequence number, sending time (ns)
+_DATA, _END = 0, 1 # kinds of datagrams: the end one carries the amount of datagrams sent as sequence number
+
+
+class TokenBucket:
+    """
+    Paces a sender to `rate` tokens per second (e.g. messages, or bytes), while allowing bursts of up to `burst` tokens.
+    Tokens accumulate over time, and each send consumes some, waiting for them to become available if needed.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = rate
+        self.burst = burst or max(rate / 100, 1) # 10ms worth of tokens, by default
+        self.__tokens = self.burst
+        self.__last = time.monotonic()
+
+    def consume(self, amount: float = 1):
+        if amount > self.burst:
+            raise ValueError(f"Cannot consume {amount} tokens at once, as the burst is {self.burst}")
+        while True:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            if self.__tokens >= amount:
+                self.__tokens -= amount
+                return
+            time.sleep((amount - self.__tokens) / self.rate) # sleeping may overshoot: tokens are refilled afterwards
+
+
+def stream(peer: Peer, count: int, size: int = 64, rate: float = None, byte_rate: float = None):
+    """
+    Sends `count` datagrams of `size` bytes to all peers, each one carrying its sequence number and sending time.
+    Sending is paced at `rate` datagrams per second, or `byte_rate` bytes per second (if any), otherwise it goes flat out.
+    Some end datagrams follow, telling receivers how many datagrams were sent.
+    """
+    padding = bytes(max(size - _HEADER.size, 0))
+    cost = len(padding) + _HEADER.size if byte_rate else 1
+    bucket = TokenBucket(byte_rate) if byte_rate else TokenBucket(rate) if rate else None
+    if bucket is not None and bucket.burst < cost:
+        bucket.burst = cost
+    start = time.perf_counter()
+    for sequence in range(count):
+        if bucket is not None:
+            bucket.consume(cost)
+        peer.send_all(_HEADER.pack(_DATA, sequence, time.time_ns()) + padding)
+    elapsed = time.perf_counter() - start
+    for _ in range(3): # best effort, as any other datagram
+        peer.send_all(_HEADER.pack(_END, count, time.time_ns()))
+        time.sleep(0.05)
+    print(f"# Sent {count} datagrams of {size} bytes in {elapsed:.2f}s ({count / elapsed:.0f} datagrams/s)")
+
+
+class StreamReport:
+    """
+    Receiver-side statistics of a stream:
+    - loss: datagrams never received, out of the ones sent (known from the end datagram, or from the highest sequence number);
+    - reordering: datagrams received after one with a higher sequence number;
+    - jitter: variation of the transit time of consecutive datagrams, smoothed as in RTP (RFC 3550),
+      which is unaffected by clock offsets among sender and receiver;
+    - throughput: datagrams and bytes received per second, from the first to the last one.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.jitter = 0.0 # seconds
+        self.sent: int | None = None # known once the end datagram arrives
+        self.__seen: set[int] = set()
+        self.__highest = -1
+        self.__last_transit: float | None = None
+        self.__first: float | None = None
+        self.__last: float | None = None
+
+    @property
+    def complete(self) -> bool:
+        return self.sent is not None
+
+    def add(self, datagram, arrival: float = None) -> None:
+        if len(datagram) < _HEADER.size: # e.g. a stray datagram, not belonging to the stream
+            return
+        arrival = time.time_ns() if arrival is None else arrival
+        kind, sequence, sent_at = _HEADER.unpack_from(datagram)
+        if kind == _END:
+            self.sent = sequence
+            return
+        if sequence in self.__seen:
+            self.duplicates += 1
+            return
+        self.__seen.add(sequence)
+        self.received += 1
+        self.bytes += len(datagram)
+        if sequence < self.__highest:
+            self.reordered += 1
+        self.__highest = max(self.__highest, sequence)
+        transit = (arrival - sent_at) / 1e9
+        if self.__last_transit is not None:
+            self.jitter += (abs(transit - self.__last_transit) - self.jitter) / 16
+        self.__last_transit = transit
+        if self.__first is None:
+            self.__first = arrival
+        self.__last = arrival
+
+    @property
+    def expected(self) -> int:
+        return self.sent if self.sent is not None else self.__highest + 1
+
+    @property
+    def loss(self) -> float:
+        return 1 - self.received / self.expected if self.expected else 0.0
+
+    @property
+    def duration(self) -> float:
+        return (self.__last - self.__first) / 1e9 if self.__first is not None and self.__last is not None else 0.0
+
+    def __str__(self):
+        rate = self.received / self.duration if self.duration else 0.0
+        byte_rate = self.bytes / self.duration if self.duration else 0.0
+        return (
+            f"received {self.received}/{self.expected} datagrams (loss {self.loss:.2%}), "
+            f"{self.reordered} reordered, {self.duplicates} duplicates, jitter {self.jitter * 1e3:.3f}ms, "
+            f"throughput {rate:.0f} datagrams/s ({byte_rate * 8 / 1e6:.2f} Mbit/s)"
+        )
+
+
+def receive_stream(peer: Peer, interval: float = 1.0, timeout: float = 5.0) -> StreamReport:
+    """
+    Receives a stream until its end datagram, printing a report every `interval` seconds, and returns the final report.
+    Since end datagrams may be lost as well, the stream is also considered over
+    if no datagram arrives for `timeout` seconds, once it started.
+    """
+    report = StreamReport()
+    next_print = None # counted from the first datagram
+    while not report.complete:
+        try:
+            batch = peer.receive_batch(None if next_print is None else timeout)
+        except TimeoutError:
+            print(f"# No datagram received for {timeout}s: assuming the stream is over")
+            break
+        for payload, _ in batch:
+            report.add(payload)
+        if next_print is None:
+            next_print = time.monotonic() + interval
+        elif time.monotonic() >= next_print:
+            print(f"# So far: {report}")
+            next_print += interval
+    print(f"# Final: {report}")
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=f'python -m snippets -l 2 -e 5',
+        description='Streams sequence-numbered datagrams at a given rate, or receives them while reporting loss, reordering, jitter and throughput',
+        exit_on_error=False,
+    )
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    sender = subparsers.add_parser('send', help='Stream datagrams to some peers')
+    sender.add_argument('count', type=int, help='Amount of datagrams to send')
+    sender.add_argument('peers', nargs='+', help='Addresses of the receivers')
+    sender.add_argument('--size', '-s', type=int, default=64, help='Size of each datagram, in bytes')
+    pacing = sender.add_mutually_exclusive_group()
+    pacing.add_argument('--rate', '-r', type=float, help='Target rate, in datagrams per second (flat out, if unset)')
+    pacing.add_argument('--byte-rate', '-b', type=float, help='Target rate, in bytes per second')
+    receiver = subparsers.add_parser('receive', help='Receive a stream, and report about it')
+    receiver.add_argument('port', type=int, help='Port to listen on')
+    receiver.add_argument('--interval', '-i', type=float, default=1.0, help='Seconds between partial reports')
+    receiver.add_argument('--timeout', '-t', type=float, default=5.0, help='Seconds without datagrams after which the stream is considered over')
+    receiver.add_argument('--buffer', type=int, default=4 * 1024 * 1024, help='Size of the receive buffer of the socket, in bytes')
+    args = parser.parse_args()
+
+    if args.mode == 'send':
+        peer = Peer(port=0, peers=[address(peer) for peer in args.peers])
+        stream(peer, args.count, args.size, args.rate, args.byte_rate)
+    else:
+        peer = Peer(port=args.port, receive_buffer_size=args.buffer)
+        try:
+            receive_stream(peer, args.interval, args.timeout)
+        except KeyboardInterrupt:
+            pass
+    peer.close()
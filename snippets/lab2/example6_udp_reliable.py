@@ -0,0 +1,382 @@
+from snippets.lab2 import *
+import os
+import random
+import struct
+import threading
+import time
+
+
+_HEADER = struct.Struct('>BQI') # kind, session, sequence number (of the datagram, or of the next datagram expected, for ACKs)
+_SACK_BLOCK = struct.Struct('>II') # first and last + 1 sequence numbers of a range of datagrams received out of order
+_DATA, _ACK, _FIN = 0, 1, 2 # FINs are delivered like data, in order, and tell that the sender left
+MAX_SACK_BLOCKS = 8
+
+
+class _Outgoing:
+    """
+    Sending side of the channel towards a peer.
+    Each channel has a random session ID, carried by all its datagrams (and by their ACKs),
+    so that receivers can tell a new channel (e.g. after the sender restarted) from an old one.
+    """
+
+    __slots__ = ('session', 'next_sequence', 'unacked', 'srtt', 'rttvar', 'rto')
+
+    def __init__(self, rto: float):
+        self.session = int.from_bytes(os.urandom(8), 'big')
+        self.next_sequence = 0
+        self.unacked: dict[int, list] = {} # sequence -> [datagram, sending time, deadline, attempts]
+        self.srtt: float | None = None # smoothed round-trip time
+        self.rttvar = 0.0
+        self.rto = rto # retransmission timeout
+
+
+class _Incoming:
+    """Receiving side of the channel from a peer"""
+
+    __slots__ = ('session', 'expected', 'buffered')
+
+    def __init__(self, session: int):
+        self.session = session # of the sending side
+        self.expected = 0 # next sequence number to deliver
+        self.buffered: dict[int, tuple[int, bytes]] = {} # datagrams received out of order: sequence -> (kind, payload)
+
+    def sack_blocks(self) -> list[tuple[int, int]]:
+        blocks: list[tuple[int, int]] = []
+        for sequence in sorted(self.buffered):
+            if blocks and blocks[-1][1] == sequence:
+                blocks[-1] = (blocks[-1][0], sequence + 1)
+            elif len(blocks) < MAX_SACK_BLOCKS:
+                blocks.append((sequence, sequence + 1))
+            else:
+                break
+        return blocks
+
+
+class ReliablePeer(Peer):
+    """
+    A peer delivering messages to each other peer exactly once and in order, despite datagrams being lost,
+    duplicated or reordered, over a single UDP socket for the whole group.
+
+    Each peer numbers the datagrams it sends to each other peer, and keeps up to `window` of them unacknowledged:
+    sending blocks while the window towards some peer is full.
+    Receivers buffer datagrams arriving out of order, deliver them as soon as the gaps are filled, and drop duplicates.
+    They acknowledge all datagrams received in a batch with a single ACK, carrying the next sequence number expected
+    (cumulative ACK), along with the ranges of datagrams received beyond it (selective ACKs, or SACKs).
+    Senders retransmit a datagram when a SACK shows that later ones were received (fast retransmission),
+    or when its retransmission timeout expires, doubling the timeout on each attempt.
+    Timeouts are estimated from round-trip times as in TCP (RFC 6298),
+    and a peer is considered lost after `max_attempts` fruitless attempts.
+
+    Datagrams carry the session ID of their channel: a peer whose session changes (e.g. because it restarted)
+    is treated as a new one, hence its receiving state is reset, as well as the channel towards it
+    (messages sent to it before, and not acknowledged yet, are dropped).
+    ACKs carry the session ID of the channel they acknowledge, so that they cannot acknowledge datagrams of another one.
+
+    `leave` sends a FIN to all peers, which is retransmitted like any other datagram, and waits for it to be acknowledged.
+    Messages are passed to the callback along with their sender, while a None message tells that the sender left (or was lost).
+    """
+
+    def __init__(self, port, peers=None, callback=None, window: int = 64,
+                 initial_rto: float = 0.2, min_rto: float = 0.02, max_rto: float = 2.0, max_attempts: int = 10, **kwargs):
+        super().__init__(port, peers, **kwargs)
+        self.__window = window
+        self.__initial_rto, self.__min_rto, self.__max_rto = initial_rto, min_rto, max_rto
+        self.__max_attempts = max_attempts
+        self.__callback = callback or (lambda *_: None)
+        self.__outgoing: dict[tuple, _Outgoing] = {}
+        self.__incoming: dict[tuple, _Incoming] = {}
+        self.__left: dict[tuple, tuple[int, int]] = {} # peers which left -> session, next sequence number after their FIN
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__receiver_thread = threading.Thread(target=self.__handle_incoming_datagrams, daemon=True)
+        self.__timer_thread = threading.Thread(target=self.__handle_timeouts, daemon=True)
+        self.__receiver_thread.start()
+        self.__timer_thread.start()
+
+    def send_all(self, message):
+        message = self._encode(message)
+        if len(message) + _HEADER.size > self.max_datagram_size:
+            raise ValueError(f"Message of {len(message)} bytes exceeds maximum datagram size ({self.max_datagram_size} bytes)")
+        for peer in tuple(self.peers):
+            self.__send(peer, _DATA, message)
+
+    def send_batch(self, messages):
+        for message in messages:
+            self.send_all(message)
+
+    def __send(self, peer, kind: int, payload: bytes = b''):
+        with self.__condition:
+            if peer not in self.__outgoing:
+                self.__outgoing[peer] = _Outgoing(self.__initial_rto)
+            outgoing = self.__outgoing[peer]
+            while len(outgoing.unacked) >= self.__window and self.__outgoing.get(peer) is outgoing and not self.__closed:
+                self.__condition.wait()
+            if self.__outgoing.get(peer) is not outgoing or self.__closed:
+                return # the peer was lost, or left, in the meanwhile
+            sequence = outgoing.next_sequence
+            outgoing.next_sequence += 1
+            datagram = _HEADER.pack(kind, outgoing.session, sequence) + payload
+            now = time.monotonic()
+            outgoing.unacked[sequence] = [datagram, now, now + outgoing.rto, 1]
+            self.__condition.notify_all() # the timer thread may need to wake up earlier
+        self.send_to(datagram, peer)
+
+    def __handle_incoming_datagrams(self):
+        try:
+            while not self.__closed:
+                deliveries: list[tuple[bytes | None, tuple]] = []
+                acks: dict[tuple, bytes] = {}
+                try:
+                    batch = self.receive_batch() # not holding the lock, while waiting for datagrams
+                except ValueError: # oversized datagram, which cannot belong to this protocol
+                    continue
+                with self.__condition:
+                    for datagram, sender in batch:
+                        if len(datagram) < _HEADER.size:
+                            continue
+                        kind, session, sequence = _HEADER.unpack_from(datagram)
+                        if kind == _ACK:
+                            self.__acknowledged(sender, session, sequence, datagram[_HEADER.size:])
+                        elif self.__received(sender, kind, session, sequence, bytes(datagram[_HEADER.size:]), deliveries):
+                            acks[sender] = self.__ack(sender)
+                    self.__condition.notify_all()
+                for peer, ack in acks.items(): # one ACK per peer per batch
+                    self.send_to(ack, peer)
+                for payload, sender in deliveries:
+                    self.on_message_received(None if payload is None else str(payload, 'utf-8'), sender)
+        except OSError:
+            if not self.__closed:
+                raise
+
+    def __received(self, sender, kind: int, session: int, sequence: int, payload: bytes, deliveries: list) -> bool:
+        """Buffers and delivers in order the given datagram, returning whether it should be acknowledged"""
+        if sender in self.__left:
+            if self.__left[sender][0] != session: # the peer joined again
+                del self.__left[sender]
+            else:
+                self.peers.discard(sender) # re-added on receipt, while it is just retransmitting its FIN
+                self.send_to(_HEADER.pack(_ACK, *self.__left[sender]), sender)
+                return False
+        incoming = self.__incoming.get(sender)
+        if incoming is None or incoming.session != session:
+            if incoming is not None: # the peer restarted, losing its receiving state as well
+                self.__outgoing.pop(sender, None)
+            incoming = self.__incoming[sender] = _Incoming(session)
+        if sequence >= incoming.expected: # otherwise, a duplicate of a delivered datagram, which is acknowledged again
+            incoming.buffered.setdefault(sequence, (kind, payload))
+            while incoming.expected in incoming.buffered:
+                kind, payload = incoming.buffered.pop(incoming.expected)
+                incoming.expected += 1
+                if kind == _FIN:
+                    self.__left[sender] = (incoming.session, incoming.expected)
+                    self.__forget(sender)
+                    deliveries.append((None, sender))
+                    break
+                deliveries.append((payload, sender))
+        return True
+
+    def __ack(self, sender) -> bytes:
+        if sender in self.__left:
+            return _HEADER.pack(_ACK, *self.__left[sender])
+        incoming = self.__incoming[sender]
+        return _HEADER.pack(_ACK, incoming.session, incoming.expected) + b''.join(_SACK_BLOCK.pack(*block) for block in incoming.sack_blocks())
+
+    def __acknowledged(self, sender, session: int, cumulative: int, sacks):
+        outgoing = self.__outgoing.get(sender)
+        if outgoing is None or outgoing.session != session: # e.g. a late ACK of a channel which was reset
+            return
+        acked = [s for s in outgoing.unacked if s < cumulative]
+        highest_sacked = cumulative - 1
+        for offset in range(0, len(sacks) - len(sacks) % _SACK_BLOCK.size, _SACK_BLOCK.size):
+            first, last = _SACK_BLOCK.unpack_from(sacks, offset)
+            acked += [s for s in range(first, last) if s in outgoing.unacked]
+            highest_sacked = max(highest_sacked, last - 1)
+        now = time.monotonic()
+        samples = [now - entry[1] for entry in (outgoing.unacked.pop(s) for s in acked) if entry[3] == 1] # Karn's algorithm
+        if samples:
+            self.__update_rto(outgoing, min(samples))
+        for sequence, entry in outgoing.unacked.items():
+            # holes below SACKed datagrams are likely lost, unless they were (re)sent less than a round-trip ago
+            if sequence < highest_sacked and now - entry[1] > (outgoing.srtt or 0):
+                self.__retransmit(sender, outgoing, entry, now)
+
+    def __update_rto(self, outgoing: _Outgoing, rtt: float):
+        if outgoing.srtt is None:
+            outgoing.srtt, outgoing.rttvar = rtt, rtt / 2
+        else:
+            outgoing.rttvar = 0.75 * outgoing.rttvar + 0.25 * abs(outgoing.srtt - rtt)
+            outgoing.srtt = 0.875 * outgoing.srtt + 0.125 * rtt
+        outgoing.rto = min(max(outgoing.srtt + 4 * outgoing.rttvar, self.__min_rto), self.__max_rto)
+
+    def __retransmit(self, peer, outgoing: _Outgoing, entry: list, now: float):
+        entry[1] = now
+        entry[2] = now + min(outgoing.rto * 2 ** entry[3], self.__max_rto) # exponential backoff
+        entry[3] += 1
+        self.send_to(entry[0], peer)
+
+    def __handle_timeouts(self):
+        with self.__condition:
+            while not self.__closed:
+                now = time.monotonic()
+                lost = []
+                deadline = now + self.__max_rto
+                for peer, outgoing in self.__outgoing.items():
+                    for entry in outgoing.unacked.values():
+                        if entry[2] <= now:
+                            if entry[3] >= self.__max_attempts:
+                                lost.append(peer)
+                                break
+                            self.__retransmit(peer, outgoing, entry, now)
+                        deadline = min(deadline, entry[2])
+                for peer in lost:
+                    self.__forget(peer)
+                    self.peers.discard(peer)
+                if lost:
+                    self.__condition.notify_all()
+                    self.__condition.release() # callbacks are not called while holding the lock
+                    try:
+                        for peer in lost:
+                            self.on_message_received(None, peer)
+                    finally:
+                        self.__condition.acquire()
+                self.__condition.wait(max(deadline - time.monotonic(), 0))
+
+    def __forget(self, peer):
+        self.__outgoing.pop(peer, None)
+        self.__incoming.pop(peer, None)
+        self.peers.discard(peer)
+
+    def on_message_received(self, payload, sender):
+        self.__callback(payload, sender)
+
+    def flush(self, timeout: float = None) -> bool:
+        """Waits for all messages sent so far to be acknowledged (or their receivers to be lost), returning whether they were"""
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not any(o.unacked for o in self.__outgoing.values()), timeout)
+
+    def leave(self, timeout: float = 2.0) -> bool:
+        """Tells all peers this one is leaving, and waits for them to acknowledge it, before closing"""
+        for peer in tuple(self.peers):
+            self.__send(peer, _FIN)
+        flushed = self.flush(timeout)
+        self.close()
+        return flushed
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        super().close()
+
+
+class LossyProxy:
+    """
+    Relays datagrams between a client and the `target` address, dropping, duplicating and reordering some of them at random,
+    in order to test protocols over unreliable links on a single machine.
+    The client is whoever last sent a datagram to the proxy from an address other than the target.
+    """
+
+    def __init__(self, port, target, loss: float = 0.1, duplication: float = 0.0, reordering: float = 0.0, seed: int = None):
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.__socket.bind(address(port=port))
+        host, port = address(*target) if isinstance(target, tuple) else address(target)
+        self.__target = (socket.gethostbyname(host), port) # as it appears in the sender address of datagrams
+        self.__loss, self.__duplication, self.__reordering = loss, duplication, reordering
+        self.__random = random.Random(seed)
+        self.__client = None
+        self.__held: tuple[bytes, tuple] | None = None # datagram delayed until the next one, to reorder them
+        self.relayed = self.dropped = 0
+        self.__thread = threading.Thread(target=self.__relay, daemon=True)
+        self.__thread.start()
+
+    @property
+    def local_address(self):
+        return self.__socket.getsockname()
+
+    def __relay(self):
+        self.__socket.settimeout(0.01) # held datagrams are released after a while, even if no other datagram comes
+        try:
+            while True:
+                try:
+                    datagram, sender = self.__socket.recvfrom(MAX_DATAGRAM_SIZE)
+                except TimeoutError:
+                    self.__release()
+                    continue
+                if sender == self.__target:
+                    destination = self.__client
+                else:
+                    self.__client, destination = sender, self.__target
+                if destination is None:
+                    continue
+                if self.__random.random() < self.__loss:
+                    self.dropped += 1
+                    continue
+                if self.__held is None and self.__random.random() < self.__reordering:
+                    self.__held = (datagram, destination)
+                    continue
+                self.__forward(datagram, destination)
+                if self.__random.random() < self.__duplication:
+                    self.__forward(datagram, destination)
+                self.__release()
+        except OSError:
+            pass # the socket was closed
+
+    def __release(self):
+        if self.__held is not None:
+            self.__forward(*self.__held)
+            self.__held = None
+
+    def __forward(self, datagram: bytes, destination):
+        self.__socket.sendto(datagram, destination)
+        self.relayed += 1
+
+    def close(self):
+        self.__socket.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=f'python -m snippets -l 2 -e 6',
+        description='Chat with reliable, ordered delivery over UDP, or a proxy dropping datagrams to test it',
+        exit_on_error=False,
+    )
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    chat = subparsers.add_parser('chat', help='Join a chat with reliable delivery')
+    chat.add_argument('port', type=int, help='Port to listen on')
+    chat.add_argument('peers', nargs='*', help='Addresses of other peers')
+    proxy = subparsers.add_parser('proxy', help='Relay datagrams to a peer, dropping some of them')
+    proxy.add_argument('port', type=int, help='Port to listen on')
+    proxy.add_argument('target', help='Address to relay datagrams to')
+    proxy.add_argument('--loss', type=float, default=0.1, help='Probability of dropping each datagram')
+    proxy.add_argument('--duplication', type=float, default=0.0, help='Probability of duplicating each datagram')
+    proxy.add_argument('--reordering', type=float, default=0.0, help='Probability of delaying each datagram after the next one')
+    args = parser.parse_args()
+
+    if args.mode == 'proxy':
+        relay = LossyProxy(args.port, args.target, args.loss, args.duplication, args.reordering)
+        print(f'Relaying datagrams from port {args.port} to {args.target}, press Ctrl+C to stop')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        relay.close()
+        print(f'Relayed {relay.relayed} datagrams, dropped {relay.dropped}')
+        exit(0)
+
+    def print_message(payload, sender):
+        print(f'# {sender[0]}:{sender[1]} left the chat' if payload is None else payload)
+
+    peer = ReliablePeer(args.port, [address(p) for p in args.peers], callback=print_message)
+    print(f'Bound to: {peer.local_address}')
+    username = input('Enter your username to start the chat:\n')
+    print('Type your message and press Enter to send it. Messages from other peers will be displayed below.')
+    while True:
+        try:
+            content = input()
+            peer.send_all(message(content, username))
+        except (EOFError, KeyboardInterrupt):
+            peer.leave()
+            break
+    exit(0)
@@ -0,0 +1,72 @@
+from snippets.lab2 import *
+import threading
+import time
+
+
+STRATEGIES = {
+    'unicast': lambda args: Dissemination(),
+    'multicast': lambda args: Multicast(args.group),
+    'gossip': lambda args: Gossip(args.fanout, args.rounds),
+}
+
+
+def simulate(strategy: str, size: int, messages: int, args, known: int = 8):
+    """
+    Starts `size` peers in this process, one of which broadcasts `messages` messages via the given strategy,
+    and reports the CPU time each broadcast took for the sender, and how many peers received each message.
+    Each peer initially knows `known` random other peers, but the sender, which knows all of them.
+    """
+    port = args.port if strategy == 'multicast' else 0 # all members of a multicast group share the same port
+    group = [Peer(port, receive_buffer_size=1024 * 1024, dissemination=STRATEGIES[strategy](args)) for _ in range(size)]
+    addresses = [('127.0.0.1', peer.local_address[1]) for peer in group]
+    group[0].peers.update(addresses[1:])
+    for i, peer in enumerate(group[1:], start=1):
+        peer.peers.update(random.sample([a for j, a in enumerate(addresses) if j != i], min(known, size - 1)))
+    received = [0] * size
+
+    def receive(index: int):
+        while True:
+            try:
+                received[index] += len(group[index].receive_batch())
+            except OSError:
+                return # closed
+
+    for i in range(1, size):
+        threading.Thread(target=receive, args=(i,), daemon=True).start()
+    elapsed = 0.0
+    for i in range(messages):
+        start = time.thread_time() # CPU time of the sender, excluding waits for receivers holding the GIL
+        group[0].send_all(f'Message {i}')
+        elapsed += time.thread_time() - start
+        time.sleep(0.002 * size / 100) # let receivers keep up
+    time.sleep(0.5)
+    for peer in group:
+        peer.close()
+    coverage = sum(received[1:]) / (messages * (size - 1))
+    print(f'# {strategy:>9}, {size:4d} peers: {elapsed / messages * 1e6:8.1f}µs of sender CPU per broadcast, '
+          f'{coverage:.1%} of peers reached per message')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=f'python -m snippets -l 2 -e 7',
+        description='Compares the cost and reach of broadcasts among groups of peers, via unicast, multicast or gossip',
+        exit_on_error=False,
+    )
+    parser.add_argument('--strategy', '-s', choices=STRATEGIES, action='append', help='Strategies to compare (all, by default)')
+    parser.add_argument('--sizes', '-n', type=int, nargs='+', default=[10, 100, 300], help='Sizes of the groups of peers')
+    parser.add_argument('--messages', '-m', type=int, default=100, help='Amount of messages to broadcast')
+    parser.add_argument('--group', '-g', default='239.255.0.1', help='Multicast group')
+    parser.add_argument('--port', '-p', type=int, default=8090, help='Port of the multicast group')
+    parser.add_argument('--fanout', '-k', type=int, default=4, help='Amount of peers each gossip message is forwarded to')
+    parser.add_argument('--rounds', '-r', type=int, default=8, help='Maximum amount of times gossip messages are forwarded')
+    args = parser.parse_args()
+
+    for strategy in args.strategy or STRATEGIES:
+        for size in args.sizes:
+            try:
+                simulate(strategy, size, args.messages, args)
+            except OSError as e: # e.g. multicast not supported by the network interface
+                print(f'# {strategy:>9}, {size:4d} peers: failed ({e})')
@@ -1,5 +1,8 @@
 from snippets.lab2 import *
+from collections import deque
+from contextlib import contextmanager
 import threading
+import time
 
 
 # Uncomment this line to observe timeout errors more often.
@@ -7,11 +10,73 @@ import threading
 # socket.setdefaulttimeout(5) # set default timeout for blocking operations to 5 seconds
 
 
+class Framing:
+    """
+    Length-prefixed framing of messages over a stream: each message is preceded by its length in bytes,
+    encoded as a big-endian unsigned integer of `header_size` bytes.
+    An empty frame (i.e. a zero length) signals the end of the stream.
+    Both ends of a connection must use the same framing.
+    Frames longer than `max_frame_size` are rejected as soon as their header is read, before buffering them,
+    so that a malicious or broken peer cannot make the receiver allocate gigabytes via a single header.
+    """
+
+    DEFAULT_MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, header_size: int = 2, max_frame_size: int | None = None):
+        if header_size not in (2, 4, 8):
+            raise ValueError(f"Unsupported header size: {header_size}")
+        self.header_size = header_size
+        max_length = 2 ** (8 * header_size) - 1
+        self.max_frame_size = min(max_frame_size or self.DEFAULT_MAX_FRAME_SIZE, max_length)
+
+    def frame(self, message: bytes) -> bytes:
+        if len(message) > self.max_frame_size:
+            raise ValueError(f"Message of {len(message)} bytes exceeds maximum frame size ({self.max_frame_size} bytes)")
+        return int.to_bytes(len(message), self.header_size, 'big') + message
+
+    def length(self, header) -> int:
+        length = int.from_bytes(header, 'big')
+        if length > self.max_frame_size:
+            raise ValueError(f"Incoming frame of {length} bytes exceeds maximum frame size ({self.max_frame_size} bytes)")
+        return length
+
+    def unframe(self, buffer: bytearray, text: bool = True) -> list[str | bytes | None]:
+        """
+        Extracts all complete frames from the given buffer, removing them from it.
+        Frames are returned as strings if `text` is set, as bytes otherwise.
+        Incomplete frames are left in the buffer, waiting for more data to come.
+        A None item is returned in place of the empty frame signalling the end of the stream.
+        """
+        messages: list[str | bytes | None] = []
+        start = 0
+        with memoryview(buffer) as view:
+            while len(view) - start >= self.header_size:
+                end = start + self.header_size
+                length = self.length(view[start:end])
+                if length == 0:
+                    messages.append(None)
+                    start = end
+                    break
+                if len(view) - end < length:
+                    break
+                messages.append(str(view[end:end + length], 'utf-8') if text else bytes(view[end:end + length]))
+                start = end + length
+        del buffer[:start]
+        return messages
+
+
+DEFAULT_FRAMING = Framing()
+
+
 class Connection:
-    def __init__(self, socket: socket.socket, callback=None):
+    def __init__(self, socket: socket.socket, callback=None, framing: Framing=None):
         self.__socket = socket
         self.local_address = self.__socket.getsockname()
         self.remote_address = self.__socket.getpeername()
+        self.__framing = framing or DEFAULT_FRAMING
+        self.__buffer = memoryview(bytearray(4096)) # reused by all receive operations, grown on demand
+        self.__send_lock = threading.Lock() # prevents frames sent by concurrent threads from interleaving
+        self.text = True # whether incoming messages are decoded as UTF-8 strings, or returned as bytes
         self.__notify_closed = False
         self.__callback = callback
         self.__receiver_thread = threading.Thread(target=self.__handle_incoming_messages, daemon=True)
@@ -34,17 +99,59 @@ class Connection:
     def closed(self):
         return self.__socket._closed
     
+    @property
+    def framing(self):
+        return self.__framing
+
+    @property
+    def idle(self):
+        """Whether the connection is open, and there is no incoming data (nor end of stream) waiting to be received"""
+        if self.closed:
+            return False
+        timeout = self.__socket.gettimeout()
+        self.__socket.setblocking(False)
+        try:
+            self.__socket.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            self.__socket.settimeout(timeout)
+    
     def send(self, message):
         if not isinstance(message, bytes):
             message = message.encode()
-            message = int.to_bytes(len(message), 2, 'big') + message
-        self.__socket.sendall(message)
+        message = self.__framing.frame(message)
+        with self.__send_lock:
+            self.__socket.sendall(message)
+
+    def __receive_exactly(self, size: int) -> memoryview | None:
+        if size > len(self.__buffer):
+            self.__buffer = memoryview(bytearray(max(size, min(2 * len(self.__buffer), self.__framing.max_frame_size))))
+        view = self.__buffer[:size]
+        received = 0
+        while received < size: # TCP may split a frame in several segments
+            count = self.__socket.recv_into(view[received:])
+            if count == 0:
+                if received == 0:
+                    return None
+                raise ConnectionError(f"Connection closed after receiving {received} out of {size} bytes")
+            received += count
+        return view
 
     def receive(self):
-        length = int.from_bytes(self.__socket.recv(2), 'big')
+        header = self.__receive_exactly(self.__framing.header_size)
+        if header is None:
+            return None
+        length = self.__framing.length(header)
         if length == 0:
             return None
-        return self.__socket.recv(length).decode()
+        payload = self.__receive_exactly(length)
+        if payload is None:
+            raise ConnectionError(f"Connection closed before receiving a payload of {length} bytes")
+        return str(payload, 'utf-8') if self.text else bytes(payload)
     
     def close(self):
         self.__socket.close()
@@ -73,21 +180,84 @@ class Connection:
 
 
 class Client(Connection):
-    def __init__(self, server_address, callback=None):
+    def __init__(self, server_address, callback=None, framing: Framing=None):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.bind(address(port=0))
         sock.connect(address(*server_address))
-        super().__init__(sock, callback)
+        super().__init__(sock, callback, framing)
+
+
+class ConnectionPool:
+    """
+    Keeps up to `size` idle connections towards the same server, for them to be reused across requests.
+    Idle connections are discarded if unused for more than `idle_timeout` seconds,
+    or if they are found to be closed by the server when acquired.
+    """
+
+    def __init__(self, server_address, size: int = 8, idle_timeout: float = 30.0, framing: Framing=None):
+        self.__server_address = address(*server_address)
+        self.__size = size
+        self.__idle_timeout = idle_timeout
+        self.__framing = framing
+        self.__idle: deque[tuple[Client, float]] = deque() # connections along with the time they were released
+        self.__lock = threading.Lock()
+
+    @property
+    def server_address(self):
+        return self.__server_address
+
+    @property
+    def framing(self) -> Framing:
+        return self.__framing or DEFAULT_FRAMING
+
+    def acquire(self) -> Client:
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                client, released = self.__idle.pop() # most recently used first
+            if time.monotonic() - released <= self.__idle_timeout and client.idle:
+                return client
+            client.close()
+        return Client(self.__server_address, framing=self.__framing)
+
+    def release(self, client: Client, reusable: bool = True):
+        if reusable and not client.closed:
+            with self.__lock:
+                if len(self.__idle) < self.__size:
+                    self.__idle.append((client, time.monotonic()))
+                    return
+        client.close()
+
+    @contextmanager
+    def connection(self):
+        client = self.acquire()
+        try:
+            yield client
+        except BaseException:
+            self.release(client, reusable=False) # the connection may be left in an inconsistent state
+            raise
+        self.release(client)
+
+    def close(self):
+        with self.__lock:
+            idle, self.__idle = self.__idle, deque()
+        for client, _ in idle:
+            client.close()
 
 
 class Server:
-    def __init__(self, port, callback=None):
+    def __init__(self, port, callback=None, reactor=None, framing: Framing=None, reuse_port=False):
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port: # several processes may listen on the same port, and the OS balances connections among them
+            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.__socket.bind(address(port=port))
         self.__listener_thread = threading.Thread(target=self.__handle_incoming_connections, daemon=True)
+        self.__reactor = reactor # if set, connections are served by the reactor, rather than by threads
+        self.framing = framing or DEFAULT_FRAMING # used by all accepted connections
         self.__callback = callback
         if self.__callback:
-            self.__listener_thread.start()
+            self.__start()
 
     @property
     def callback(self):
@@ -99,7 +269,17 @@ class Server:
             raise ValueError("Callback can only be set once")
         self.__callback = value
         if value:
+            self.__start()
+
+    @property
+    def local_address(self):
+        return self.__socket.getsockname()
+
+    def __start(self):
+        if self.__reactor is None:
             self.__listener_thread.start()
+        else:
+            self.__reactor.listen(self, self.__socket)
     
     def __handle_incoming_connections(self):
         self.__socket.listen()
@@ -107,7 +287,7 @@ class Server:
         try:
             while not self.__socket._closed:
                 socket, address = self.__socket.accept()
-                connection = Connection(socket)
+                connection = Connection(socket, framing=self.framing)
                 self.on_event('connect', connection, address)
         except ConnectionAbortedError as e:
             pass # silently ignore error, because this is simply the socket being closed locally
@@ -120,4 +300,7 @@ class Server:
         self.__callback(event, connection, address, error)
 
     def close(self):
-        self.__socket.close()
+        if self.__reactor is None:
+            self.__socket.close()
+        else:
+            self.__reactor.stop_listening(self.__socket)
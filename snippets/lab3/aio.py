@@ -0,0 +1,135 @@
+from snippets.lab3 import address, Framing, DEFAULT_FRAMING
+import asyncio
+
+
+class AsyncConnection:
+    """
+    Asyncio counterpart of `Connection`: same length-prefixed framing, but coroutine-based.
+    Incoming messages can either be received one by one, or iterated via `async for`.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, framing: Framing=None):
+        self.__reader = reader
+        self.__writer = writer
+        self.__framing = framing or DEFAULT_FRAMING
+        self.text = True # whether incoming messages are decoded as UTF-8 strings, or returned as bytes
+        self.local_address = writer.get_extra_info('sockname')
+        self.remote_address = writer.get_extra_info('peername')
+
+    @property
+    def closed(self):
+        return self.__writer.is_closing()
+
+    async def send(self, message):
+        if not isinstance(message, bytes):
+            message = message.encode()
+        self.__writer.write(self.__framing.frame(message))
+        await self.__writer.drain()
+
+    async def receive(self):
+        try:
+            header = await self.__reader.readexactly(self.__framing.header_size)
+            length = self.__framing.length(header)
+            if length == 0:
+                return None
+            payload = await self.__reader.readexactly(length)
+            return payload.decode() if self.text else payload
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise
+            return None # connection closed by the remote peer
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        if not self.__writer.is_closing():
+            self.__writer.close()
+        try:
+            await self.__writer.wait_closed()
+        except ConnectionError:
+            pass # the remote peer may have already reset the connection
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+
+class AsyncClient(AsyncConnection):
+    @classmethod
+    async def connect(cls, server_address, framing: Framing=None) -> 'AsyncClient':
+        host, port = address(*server_address)
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, framing)
+
+
+class AsyncServer:
+    """
+    Asyncio counterpart of `Server`: the handler coroutine is started once per incoming connection,
+    and the connection is closed when the handler returns.
+    """
+
+    def __init__(self, port, handler, framing: Framing=None):
+        self.__port = port
+        self.__handler = handler
+        self.__framing = framing
+        self.__server: asyncio.Server | None = None
+
+    @property
+    def local_address(self):
+        assert self.__server is not None, "Server not started"
+        return self.__server.sockets[0].getsockname()
+
+    async def start(self):
+        host, port = address(port=self.__port)
+        self.__server = await asyncio.start_server(self.__on_connection, host, port)
+        return self
+
+    async def __on_connection(self, reader, writer):
+        async with AsyncConnection(reader, writer, self.__framing) as connection:
+            await self.__handler(connection)
+
+    async def serve_forever(self):
+        if self.__server is None:
+            await self.start()
+        assert self.__server is not None
+        await self.__server.serve_forever()
+
+    async def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *_):
+        await self.close()
+
+
+if __name__ == '__main__':
+    async def echo(connection: AsyncConnection):
+        async for message in connection:
+            await connection.send(message)
+
+    async def ping(server_address, i):
+        async with await AsyncClient.connect(server_address) as client:
+            await client.send(f"Hello from client {i}")
+            return await client.receive()
+
+    async def main(clients=1000):
+        async with AsyncServer(0, echo) as server:
+            server_address = ('localhost', server.local_address[1])
+            replies = await asyncio.gather(*(ping(server_address, i) for i in range(clients)))
+            assert replies == [f"Hello from client {i}" for i in range(clients)]
+            print(f"{clients} concurrent clients served by {server_address[0]}:{server_address[1]}")
+
+    asyncio.run(main())
@@ -0,0 +1,271 @@
+from snippets.lab3 import *
+from collections import deque
+import itertools
+import selectors
+
+
+BUFFER_SIZE = 64 * 1024
+
+
+class EventLoop:
+    """
+    A single thread multiplexing many non-blocking sockets via `selectors`.
+    Handlers are registered along with sockets, and they are called (on the loop thread) with the ready events mask.
+    Other threads must interact with the loop via `call_soon`, as selectors are not thread-safe.
+    """
+
+    def __init__(self, name=None):
+        self.__selector = selectors.DefaultSelector()
+        self.__pending = deque() # callables to be executed on the loop thread
+        self.__wakeup_receiver, self.__wakeup_sender = socket.socketpair()
+        self.__wakeup_receiver.setblocking(False)
+        self.__wakeup_sender.setblocking(False)
+        self.__selector.register(self.__wakeup_receiver, selectors.EVENT_READ, self.__on_wakeup)
+        self.__running = True
+        self.read_buffer = memoryview(bytearray(BUFFER_SIZE)) # shared by all sockets served by this loop
+        self.__thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self.__thread.start()
+
+    @property
+    def in_loop_thread(self):
+        return threading.get_ident() == self.__thread.ident
+
+    def call_soon(self, function, *args):
+        self.__pending.append((function, args))
+        if not self.in_loop_thread:
+            try:
+                self.__wakeup_sender.send(b'\0')
+            except OSError:
+                pass # the loop is either already awake or stopped
+
+    def register(self, sock, events, handler):
+        self.__selector.register(sock, events, handler)
+
+    def modify(self, sock, events, handler):
+        self.__selector.modify(sock, events, handler)
+
+    def unregister(self, sock):
+        self.__selector.unregister(sock)
+
+    def stop(self):
+        self.call_soon(self.__stop)
+
+    def __stop(self):
+        self.__running = False
+
+    def __on_wakeup(self, mask):
+        try:
+            while self.__wakeup_receiver.recv(BUFFER_SIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __run(self):
+        try:
+            while self.__running:
+                for key, mask in self.__selector.select():
+                    key.data(mask)
+                while self.__pending:
+                    function, args = self.__pending.popleft()
+                    function(*args)
+        finally:
+            self.__selector.close()
+            self.__wakeup_receiver.close()
+            self.__wakeup_sender.close()
+
+
+class ReactorConnection:
+    """
+    Counterpart of `Connection` for sockets served by an `EventLoop`, rather than by a dedicated receiver thread.
+    Exposes the same `callback(event, payload, connection, error)` contract and the same `send`/`close` methods.
+    """
+
+    def __init__(self, socket: socket.socket, loop: EventLoop, callback=None, framing: Framing=None):
+        socket.setblocking(False)
+        self.__socket = socket
+        self.__loop = loop
+        self.__framing = framing or DEFAULT_FRAMING
+        self.text = True # whether incoming messages are decoded as UTF-8 strings, or delivered as bytes
+        self.local_address = self.__socket.getsockname()
+        self.remote_address = self.__socket.getpeername()
+        self.__lock = threading.Lock()
+        self.__inbox = bytearray()
+        self.__outbox = bytearray()
+        self.__events = 0 # events the socket is currently registered for
+        self.__closing = False
+        self.__callback = callback
+        if self.__callback:
+            self.__loop.call_soon(self.__update_registration)
+
+    @property
+    def callback(self):
+        return self.__callback or (lambda *_: None)
+
+    @callback.setter
+    def callback(self, value):
+        if self.__callback:
+            raise ValueError("Callback can only be set once")
+        self.__callback = value
+        if value:
+            self.__loop.call_soon(self.__update_registration)
+
+    @property
+    def closed(self):
+        return self.__closing
+
+    @property
+    def framing(self):
+        return self.__framing
+
+    def send(self, message):
+        if not isinstance(message, bytes):
+            message = message.encode()
+        message = self.__framing.frame(message)
+        with self.__lock:
+            if self.__closing:
+                raise ConnectionError("Connection is closed")
+            if self.__outbox: # writes are already waiting for the socket to be writable
+                self.__outbox += message
+                return
+            try:
+                sent = self.__socket.send(message)
+            except BlockingIOError:
+                sent = 0
+            if sent < len(message):
+                self.__outbox += message[sent:]
+                self.__loop.call_soon(self.__update_registration)
+
+    def close(self):
+        with self.__lock:
+            if self.__closing:
+                return
+            self.__closing = True
+        self.__loop.call_soon(self.__update_registration)
+
+    def __update_registration(self):
+        # always executed on the loop thread
+        with self.__lock:
+            finalize = self.__closing and not self.__outbox
+            events = selectors.EVENT_WRITE if self.__outbox else 0
+        if finalize:
+            self.__finalize()
+            return
+        if self.__callback and not self.__closing:
+            events |= selectors.EVENT_READ
+        if events == self.__events or self.__socket._closed:
+            return
+        if not self.__events:
+            self.__loop.register(self.__socket, events, self.__on_ready)
+        else:
+            self.__loop.modify(self.__socket, events, self.__on_ready)
+        self.__events = events
+
+    def __finalize(self):
+        if self.__events:
+            self.__loop.unregister(self.__socket)
+            self.__events = 0
+        if not self.__socket._closed:
+            self.__socket.close()
+            self.on_event('close')
+
+    def __on_ready(self, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.__flush()
+            if mask & selectors.EVENT_READ:
+                self.__read()
+        except Exception as e:
+            self.on_event('error', error=e)
+            with self.__lock:
+                self.__closing = True
+                self.__outbox.clear()
+            self.__update_registration()
+
+    def __flush(self):
+        with self.__lock:
+            try:
+                sent = self.__socket.send(self.__outbox)
+                del self.__outbox[:sent]
+            except BlockingIOError:
+                return
+        if not self.__outbox:
+            self.__update_registration()
+
+    def __read(self):
+        buffer = self.__loop.read_buffer
+        try:
+            count = self.__socket.recv_into(buffer)
+        except BlockingIOError:
+            return
+        if count == 0: # remote peer closed the connection
+            self.close()
+            return
+        self.__inbox += buffer[:count]
+        for message in self.__framing.unframe(self.__inbox, self.text): # rejects oversized headers
+            if message is None:
+                self.close()
+            if self.__closing:
+                return
+            self.on_event('message', message)
+        if len(self.__inbox) > self.__framing.header_size + self.__framing.max_frame_size: # at most one partial frame
+            raise ValueError(f"Incoming data exceeds maximum frame size ({self.__framing.max_frame_size} bytes)")
+
+    def on_event(self, event: str, payload: str=None, connection: 'ReactorConnection'=None, error: Exception=None):
+        if connection is None:
+            connection = self
+        self.callback(event, payload, connection, error)
+
+
+class Reactor:
+    """
+    Serves the connections of one or more `Server`s via a fixed number of event loops (i.e. threads),
+    instead of spawning one thread per connection.
+    The first loop accepts incoming connections, which are then assigned to loops in a round-robin fashion.
+    """
+
+    def __init__(self, workers: int = 1):
+        assert workers > 0, "At least one worker is required"
+        self.__loops = [EventLoop(name=f'reactor-{i}') for i in range(workers)]
+        self.__next_loop = itertools.cycle(self.__loops)
+        self.__servers: dict[socket.socket, Server] = {}
+
+    @property
+    def __acceptor(self):
+        return self.__loops[0]
+
+    def listen(self, server: Server, sock: socket.socket):
+        sock.listen()
+        sock.setblocking(False)
+        self.__acceptor.call_soon(self.__start_listening, server, sock)
+
+    def __start_listening(self, server, sock):
+        self.__servers[sock] = server
+        self.__acceptor.register(sock, selectors.EVENT_READ, lambda _: self.__accept(server, sock))
+        server.on_event('listen', address=sock.getsockname())
+
+    def __accept(self, server, sock):
+        while True: # accept all pending connections at once
+            try:
+                connection_socket, address = sock.accept()
+            except BlockingIOError:
+                return
+            except Exception as e:
+                server.on_event('error', error=e)
+                return
+            connection = ReactorConnection(connection_socket, next(self.__next_loop), framing=server.framing)
+            server.on_event('connect', connection, address)
+
+    def stop_listening(self, sock: socket.socket):
+        self.__acceptor.call_soon(self.__stop_listening, sock)
+
+    def __stop_listening(self, sock):
+        server = self.__servers.pop(sock, None)
+        if server is not None:
+            self.__acceptor.unregister(sock)
+        sock.close()
+        if server is not None:
+            server.on_event('stop')
+
+    def close(self):
+        for loop in self.__loops:
+            loop.stop()
@@ -1,6 +1,12 @@
 from .users import User, Credentials, Token, Role
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from typing import Callable, Protocol
+import dataclasses
 import json
+import struct
+import types
+import typing
 from dataclasses import dataclass
 
 
@@ -8,10 +14,14 @@ from dataclasses import dataclass
 class Request:
     """
     A container for RPC requests: a name of the function to call and its arguments.
+    The optional ID lets clients match responses to requests, when many requests are in flight on the same connection.
+    If stream is set, the result (which must be iterable) is sent back one item at a time, via `StreamItem`s.
     """
 
     name: str
     args: tuple
+    id: int | None = None
+    stream: bool = False
 
     def __post_init__(self):
         self.args = tuple(self.args)
@@ -23,21 +33,422 @@ class Response:
     A container for RPC responses: a result of the function call or an error message.
     When error is None, it means there was no error.
     Result may be None, if the function returns None.
+    ID is the one of the request this response answers to.
     """
 
     result: object | None
     error: str | None
+    id: int | None = None
+
+
+RESPONSE_TOO_LARGE = "Response exceeds maximum frame size" # prefix of the error sent in place of such responses
+
+
+@dataclass
+class StreamItem:
+    """
+    A container for one item of the result of a streamed request.
+    Items are sent back in order, and they are followed by a `Response` with no result, which closes the stream
+    (and which carries an error, if the stream was interrupted by one).
+    """
+
+    item: object | None
+    id: int | None = None
+
+
+@dataclass
+class BatchRequest:
+    """
+    A container for many RPC requests, sent together to save round trips.
+    Requests are executed in order, and answered by a single `BatchResponse`.
+    """
+
+    requests: list[Request]
+    id: int | None = None
+
+    def __post_init__(self):
+        self.requests = list(self.requests)
+
+
+@dataclass
+class BatchResponse:
+    """
+    A container for the responses to the requests of a `BatchRequest`, in the same order.
+    """
+
+    responses: list[Response]
+    id: int | None = None
+
+    def __post_init__(self):
+        self.responses = list(self.responses)
+
+
+class Codec(Protocol):
+    """
+    Converts ASTs (i.e. the outcome of `Serializer._to_ast`) to strings or bytes, and back.
+    ASTs are made of dicts, lists, primitive values, and datetimes, which each codec represents in its own way.
+    Malformed data is reported via ValueError.
+    """
+
+    def encode(self, data) -> str | bytes:
+        ...
+
+    def decode(self, data: str | bytes):
+        ...
+
+
+class JsonCodec(Codec):
+    def __init__(self, indent: int | None = 2):
+        self.indent = indent
+
+    def encode(self, data) -> str:
+        return json.dumps(data, indent=self.indent, default=self.__encode_datetime)
+
+    def decode(self, data: str | bytes):
+        return json.loads(data, object_hook=self.__decode_datetime)
+
+    @staticmethod
+    def __encode_datetime(value):
+        if isinstance(value, datetime):
+            return {'iso': value.isoformat(), '$type': 'datetime'}
+        raise TypeError(f"Unsupported type {type(value)}")
+
+    @staticmethod
+    def __decode_datetime(data: dict):
+        if data.get('$type') == 'datetime':
+            return datetime.fromisoformat(data['iso'])
+        return data
+
+
+class BinaryCodec(Codec):
+    """
+    Compact binary encoding of ASTs.
+    Each value is preceded by a 1-byte tag telling its type,
+    integers and lengths are encoded as variable-length integers,
+    strings and containers are preceded by their length,
+    datetimes are encoded as integer microseconds since the epoch (plus the UTC offset in seconds, if any).
+    Objects of well-known types are encoded by means of an interned tag, followed by their fields' values in a fixed order.
+    Whole messages start with `MAGIC`, which is not a valid first byte for UTF-8 text (hence for JSON).
+    """
+
+    MAGIC = b'\xb1'
+
+    NONE, FALSE, TRUE, INT, NEGATIVE_INT, FLOAT, STR, LIST, DICT, DATETIME, AWARE_DATETIME = range(11)
+
+    EPOCH = datetime(1970, 1, 1)
+    AWARE_EPOCH = EPOCH.replace(tzinfo=timezone.utc)
+    MICROSECOND = timedelta(microseconds=1)
+
+    TYPES_OFFSET = 0x10
+    TYPES: dict[str, tuple[str, ...]] = { # well-known types, along with their fields: only append new types here
+        'User': ('username', 'emails', 'full_name', 'role', 'password'),
+        'Credentials': ('id', 'password'),
+        'Token': ('signature', 'user', 'expiration'),
+        'Role': ('name',),
+        'Request': ('name', 'args', 'id', 'stream'),
+        'Response': ('result', 'error', 'id'),
+        'BatchRequest': ('requests', 'id'),
+        'BatchResponse': ('responses', 'id'),
+        'StreamItem': ('item', 'id'),
+        'timedelta': ('microseconds',),
+    }
+
+    def __init__(self):
+        self.__type_tags = {name: self.TYPES_OFFSET + i for i, name in enumerate(self.TYPES)}
+        self.__tag_types = {tag: (name, self.TYPES[name]) for name, tag in self.__type_tags.items()}
+
+    def encode(self, data) -> bytes:
+        buffer = bytearray(self.MAGIC)
+        self.__encode(data, buffer)
+        return bytes(buffer)
+
+    @staticmethod
+    def __encode_uint(value: int, buffer: bytearray):
+        while value >= 0x80:
+            buffer.append((value & 0x7F) | 0x80)
+            value >>= 7
+        buffer.append(value)
+
+    def __encode_int(self, value: int, buffer: bytearray):
+        self.__encode_uint(value << 1 if value >= 0 else (-value << 1) - 1, buffer) # zigzag encoding
+
+    def __encode(self, value, buffer: bytearray):
+        if isinstance(value, str):
+            buffer.append(self.STR)
+            self.__encode_str(value, buffer)
+        elif value is None:
+            buffer.append(self.NONE)
+        elif value is True:
+            buffer.append(self.TRUE)
+        elif value is False:
+            buffer.append(self.FALSE)
+        elif isinstance(value, int):
+            buffer.append(self.INT if value >= 0 else self.NEGATIVE_INT)
+            self.__encode_uint(abs(value), buffer)
+        elif isinstance(value, float):
+            buffer.append(self.FLOAT)
+            buffer += struct.pack('>d', value)
+        elif isinstance(value, datetime):
+            offset = value.utcoffset()
+            if offset is None:
+                buffer.append(self.DATETIME)
+                self.__encode_int((value - self.EPOCH) // self.MICROSECOND, buffer)
+            else:
+                buffer.append(self.AWARE_DATETIME)
+                self.__encode_int((value - self.AWARE_EPOCH) // self.MICROSECOND, buffer)
+                self.__encode_int(offset // timedelta(seconds=1), buffer)
+        elif isinstance(value, list):
+            buffer.append(self.LIST)
+            self.__encode_uint(len(value), buffer)
+            for item in value:
+                self.__encode(item, buffer)
+        elif isinstance(value, dict):
+            fields = self.TYPES.get(value.get('$type', ''))
+            if fields is not None and len(value) == len(fields) + 1 and all(field in value for field in fields):
+                buffer.append(self.__type_tags[value['$type']])
+                for field in fields:
+                    self.__encode(value[field], buffer)
+            else:
+                buffer.append(self.DICT)
+                self.__encode_uint(len(value), buffer)
+                for key, item in value.items():
+                    self.__encode_str(key, buffer)
+                    self.__encode(item, buffer)
+        else:
+            raise ValueError(f"Unsupported type {type(value)}")
+
+    def __encode_str(self, value: str, buffer: bytearray):
+        encoded = value.encode('utf-8')
+        self.__encode_uint(len(encoded), buffer)
+        buffer += encoded
+
+    def decode(self, data: str | bytes):
+        if isinstance(data, str) or data[:1] != self.MAGIC:
+            raise ValueError("Not a binary-encoded message")
+        try:
+            with memoryview(data) as view:
+                value, end = self.__decode(view, 1)
+        except (IndexError, struct.error, UnicodeDecodeError) as e: # e.g. truncated data
+            raise ValueError(f"Malformed binary message: {e}") from e
+        if end != len(data):
+            raise ValueError(f"Unexpected trailing data at position {end}")
+        return value
+
+    @staticmethod
+    def __decode_uint(data: memoryview, start: int) -> tuple[int, int]:
+        byte = data[start]
+        if byte < 0x80: # fast path for small integers
+            return byte, start + 1
+        value = shift = 0
+        while True:
+            byte = data[start]
+            start += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, start
+            shift += 7
+
+    def __decode_int(self, data: memoryview, start: int) -> tuple[int, int]:
+        value, start = self.__decode_uint(data, start)
+        return (value >> 1 if not value & 1 else -((value + 1) >> 1)), start
+
+    def __decode_str(self, data: memoryview, start: int) -> tuple[str, int]:
+        length, start = self.__decode_uint(data, start)
+        end = start + length
+        if end > len(data):
+            raise ValueError(f"Malformed binary message: string of {length} bytes at position {start} exceeds message")
+        return str(data[start:end], 'utf-8'), end
+
+    def __decode(self, data: memoryview, start: int) -> tuple[object, int]:
+        tag = data[start]
+        start += 1
+        if tag == self.STR:
+            return self.__decode_str(data, start)
+        if tag in self.__tag_types:
+            name, fields = self.__tag_types[tag]
+            result = {}
+            for field in fields:
+                result[field], start = self.__decode(data, start)
+            result['$type'] = name
+            return result, start
+        if tag == self.NONE:
+            return None, start
+        if tag == self.TRUE:
+            return True, start
+        if tag == self.FALSE:
+            return False, start
+        if tag == self.INT or tag == self.NEGATIVE_INT:
+            value, start = self.__decode_uint(data, start)
+            return (value if tag == self.INT else -value), start
+        if tag == self.FLOAT:
+            return struct.unpack_from('>d', data, start)[0], start + 8
+        if tag == self.DATETIME:
+            microseconds, start = self.__decode_int(data, start)
+            return self.EPOCH + microseconds * self.MICROSECOND, start
+        if tag == self.AWARE_DATETIME:
+            microseconds, start = self.__decode_int(data, start)
+            offset, start = self.__decode_int(data, start)
+            utc = self.AWARE_EPOCH + microseconds * self.MICROSECOND
+            return utc.astimezone(timezone(timedelta(seconds=offset))), start
+        if tag == self.LIST:
+            length, start = self.__decode_uint(data, start)
+            if length > len(data) - start: # each item takes at least one byte
+                raise ValueError(f"Malformed binary message: list of {length} items at position {start} exceeds message")
+            items: list[object] = [None] * length
+            for i in range(length):
+                items[i], start = self.__decode(data, start)
+            return items, start
+        if tag == self.DICT:
+            length, start = self.__decode_uint(data, start)
+            result = {}
+            for _ in range(length):
+                key, start = self.__decode_str(data, start)
+                result[key], start = self.__decode(data, start)
+            return result, start
+        raise ValueError(f"Unknown tag {tag} at position {start - 1}")
+
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+CODECS: dict[str, Codec] = {'json': JSON, 'binary': BINARY}
+
+
+def detect_codec(data: str | bytes) -> Codec:
+    if isinstance(data, (bytes, bytearray, memoryview)) and data[:1] == BinaryCodec.MAGIC:
+        return BINARY
+    return JSON
+
+
+class TypeRegistry:
+    """
+    Associates types with the functions converting their instances to ASTs, and back.
+    Encoders have signature `encoder(obj, to_ast) -> dict`, decoders have signature `decoder(data, to_obj) -> obj`,
+    where `to_ast` and `to_obj` are the functions to be used to convert nested values.
+    Converters for dataclasses and enums can be omitted upon registration, as they are derived from the type itself.
+    Instances of subclasses are converted as the closest registered superclass.
+    """
+
+    def __init__(self):
+        self.__encoders: dict[type, Callable | None] = {}
+        self.__decoders: dict[str, Callable] = {}
+
+    def register(self, cls: type, encoder: Callable = None, decoder: Callable = None, name: str = None):
+        name = name or cls.__name__
+        if encoder is None or decoder is None:
+            default_encoder, default_decoder = self.__compile(cls, name)
+            encoder = encoder or default_encoder
+            decoder = decoder or default_decoder
+        self.__encoders[cls] = encoder
+        self.__decoders[name] = decoder
+        for subclass in [t for t, e in self.__encoders.items() if e is None]:
+            del self.__encoders[subclass] # forget cached misses, as they may now be resolved
+        return cls
+
+    def encoder(self, cls: type) -> Callable | None:
+        try:
+            return self.__encoders[cls]
+        except KeyError:
+            resolved = next((self.__encoders[base] for base in cls.__mro__[1:] if self.__encoders.get(base)), None)
+            self.__encoders[cls] = resolved
+            return resolved
+
+    def decoder(self, name: str) -> Callable | None:
+        return self.__decoders.get(name)
+
+    @staticmethod
+    def __compile(cls: type, name: str) -> tuple[Callable, Callable]:
+        if isinstance(cls, type) and issubclass(cls, Enum):
+            def encode_enum(obj, to_ast):
+                return {'name': obj.name, '$type': name}
+
+            def decode_enum(data, to_obj):
+                return cls[data['name']]
+
+            return encode_enum, decode_enum
+        if dataclasses.is_dataclass(cls):
+            return _compile_dataclass_converters(cls, name)
+        raise ValueError(f"Cannot derive converters for type {cls}, please provide them explicitly")
+
+
+_PRIMITIVE_TYPES = (int, float, str, bool, type(None), datetime)
+_COLLECTION_TYPES = (list, set, frozenset, tuple)
+
+
+def _is_primitive(hint) -> bool:
+    if hint in _PRIMITIVE_TYPES:
+        return True
+    if typing.get_origin(hint) in (typing.Union, types.UnionType):
+        return all(_is_primitive(arg) for arg in typing.get_args(hint))
+    return False
+
+
+def _is_primitive_collection(hint) -> bool:
+    return typing.get_origin(hint) in _COLLECTION_TYPES and \
+        all(arg is Ellipsis or _is_primitive(arg) for arg in typing.get_args(hint))
+
+
+def _compile_dataclass_converters(cls, name: str) -> tuple[Callable, Callable]:
+    """
+    Generates the source code of an encoder and a decoder specialised for the given dataclass,
+    similarly to what the `dataclasses` module does for `__init__`.
+    Fields annotated with primitive types (or collections of primitive types) are copied as they are,
+    without recurring into `to_ast` or `to_obj`.
+    """
+    hints = typing.get_type_hints(cls)
+    namespace: dict[str, object] = {'cls': cls}
+    encoded, decoded = [], []
+    for field in dataclasses.fields(cls):
+        if not field.init:
+            continue
+        hint = hints.get(field.name)
+        value = f"obj.{field.name}"
+        item = f"data[{field.name!r}]"
+        if _is_primitive(hint):
+            encoded.append(f"{field.name!r}: {value}")
+        elif _is_primitive_collection(hint):
+            namespace[f'{field.name}_type'] = typing.get_origin(hint)
+            encoded.append(f"{field.name!r}: list({value})")
+            item = f"{field.name}_type({item})"
+        else:
+            encoded.append(f"{field.name!r}: to_ast({value})")
+            item = f"to_obj({item})"
+        if field.default is not dataclasses.MISSING: # missing items get default values, for backward compatibility
+            namespace[f'{field.name}_default'] = field.default
+            item = f"{item} if {field.name!r} in data else {field.name}_default"
+        elif field.default_factory is not dataclasses.MISSING:
+            namespace[f'{field.name}_factory'] = field.default_factory
+            item = f"{item} if {field.name!r} in data else {field.name}_factory()"
+        decoded.append(f"{field.name}={item}")
+    encoded.append(f"'$type': {name!r}")
+    source = f"def encode(obj, to_ast):\n    return {{{', '.join(encoded)}}}\n" + \
+        f"def decode(data, to_obj):\n    return cls({', '.join(decoded)})\n"
+    exec(source, namespace)
+    return namespace['encode'], namespace['decode'] # type: ignore[return-value]
+
+
+DEFAULT_REGISTRY = TypeRegistry()
+for cls in (User, Credentials, Token, Role, Request, Response, StreamItem, BatchRequest, BatchResponse):
+    DEFAULT_REGISTRY.register(cls)
+DEFAULT_REGISTRY.register(
+    timedelta,
+    encoder=lambda obj, to_ast: {'microseconds': obj // timedelta(microseconds=1), '$type': 'timedelta'},
+    decoder=lambda data, to_obj: timedelta(microseconds=data['microseconds']),
+)
 
 
 class Serializer:
-    primitive_types = (int, float, str, bool, type(None))
-    container_types = (list, set)
+    primitive_types = (int, float, str, bool, type(None), datetime) # datetimes are encoded by codecs
+    container_types = (list, set, frozenset, tuple)
+
+    def __init__(self, codec: Codec = None, registry: TypeRegistry = None):
+        self.codec = codec or JSON
+        self.registry = registry or DEFAULT_REGISTRY
 
     def serialize(self, obj):
         return self._ast_to_string(self._to_ast(obj))
 
     def _ast_to_string(self, data):
-        return json.dumps(data, indent=2)
+        return self.codec.encode(data)
 
     def _to_ast(self, obj):
         if isinstance(obj, self.primitive_types):
@@ -46,122 +457,46 @@ class Serializer:
             return [self._to_ast(item) for item in obj]
         if isinstance(obj, dict):
             return {key: self._to_ast(value) for key, value in obj.items()}
-        # selects the appropriate method to convert the object to AST via reflection
-        method_name = f'_{type(obj).__name__.lower()}_to_ast'
-        if hasattr(self, method_name):
-            data = getattr(self, method_name)(obj)
-            data['$type'] = type(obj).__name__
-            return data
-        raise ValueError(f"Unsupported type {type(obj)}")
-
-    def _user_to_ast(self, user: User):
-        return {
-            'username': self._to_ast(user.username),
-            'emails': [self._to_ast(email) for email in user.emails],
-            'full_name': self._to_ast(user.full_name),
-            'role': self._to_ast(user.role),
-            'password': self._to_ast(user.password),
-        }
-
-    def _credentials_to_ast(self, credentials: Credentials):
-        return {
-            'id': self._to_ast(credentials.id),
-            'password': self._to_ast(credentials.password),
-        }
-
-    def _token_to_ast(self, token: Token):
-        return {
-            'signature': self._to_ast(token.signature),
-            'user': self._to_ast(token.user),
-            'expiration': self._to_ast(token.expiration),
-        }
-
-    def _datetime_to_ast(self, dt: datetime):
-        raise NotImplementedError("Missing implementation for datetime serialization")
-
-    def _role_to_ast(self, role: Role):
-        return {'name': role.name}
-
-    def _request_to_ast(self, request: Request):
-        return {
-            'name': self._to_ast(request.name),
-            'args': [self._to_ast(arg) for arg in request.args],
-        }
-
-    def _response_to_ast(self, response: Response):
-        return {
-            'result': self._to_ast(response.result) if response.result is not None else None,
-            'error': self._to_ast(response.error),
-        }
+        encoder = self.registry.encoder(type(obj))
+        if encoder is None:
+            raise ValueError(f"Unsupported type {type(obj)}")
+        return encoder(obj, self._to_ast)
 
 
 class Deserializer:
+    def __init__(self, codec: Codec = None, registry: TypeRegistry = None):
+        self.codec = codec # if None, the codec is detected from each message
+        self.registry = registry or DEFAULT_REGISTRY
+
     def deserialize(self, string):
         return self._ast_to_obj(self._ast_to_string(string))
 
     def _ast_to_string(self, data):
-        return json.loads(data)
+        return (self.codec or detect_codec(data)).decode(data)
 
     def _ast_to_obj(self, data):
         if isinstance(data, dict):
             if '$type' not in data:
                 return {key: self._ast_to_obj(value) for key, value in data.items()}
-            # selects the appropriate method to convert the AST to object via reflection
-            method_name = f'_ast_to_{data["$type"].lower()}'
-            if hasattr(self, method_name):
-                return getattr(self, method_name)(data)
-            raise ValueError(f"Unsupported type {data['type']}")
+            decoder = self.registry.decoder(data['$type'])
+            if decoder is None:
+                raise ValueError(f"Unsupported type {data['$type']}")
+            return decoder(data, self._ast_to_obj)
         if isinstance(data, list):
             return [self._ast_to_obj(item) for item in data]
         return data
 
-    def _ast_to_user(self, data):
-        return User(
-            username=self._ast_to_obj(data['username']),
-            emails=set(self._ast_to_obj(data['emails'])),
-            full_name=self._ast_to_obj(data['full_name']),
-            role=self._ast_to_obj(data['role']),
-            password=self._ast_to_obj(data['password']),
-        )
-
-    def _ast_to_credentials(self, data):
-        return Credentials(
-            id=self._ast_to_obj(data['id']),
-            password=self._ast_to_obj(data['password']),
-        )
-
-    def _ast_to_token(self, data):
-        return Token(
-            signature=self._ast_to_obj(data['signature']),
-            user=self._ast_to_obj(data['user']),
-            expiration=self._ast_to_obj(data['expiration']),
-        )
-
-    def _ast_to_datetime(self, data):
-        raise NotImplementedError("Missing implementation for datetime deserialization")
-
-    def _ast_to_role(self, data):
-        return Role[self._ast_to_obj(data['name'])]
-
-    def _ast_to_request(self, data):
-        return Request(
-            name=self._ast_to_obj(data['name']),
-            args=tuple(self._ast_to_obj(arg) for arg in data['args']),
-        )
-
-    def _ast_to_response(self, data):
-        return Response(
-            result=self._ast_to_obj(data['result']) if data['result'] is not None else None,
-            error=self._ast_to_obj(data['error']),
-        )
-
 
 DEFAULT_SERIALIZER = Serializer()
 DEFAULT_DESERIALIZER = Deserializer()
+SERIALIZERS: dict[Codec, Serializer] = {codec: Serializer(codec) for codec in CODECS.values()}
 
 
-def serialize(obj):
-    return DEFAULT_SERIALIZER.serialize(obj)
+def serialize(obj, codec: Codec = None):
+    if codec is None:
+        return DEFAULT_SERIALIZER.serialize(obj)
+    serializer = SERIALIZERS.get(codec) or Serializer(codec) # any codec works, not only the registered ones
+    return serializer.serialize(obj)
 
 
 def deserialize(string):
@@ -169,7 +504,7 @@ def deserialize(string):
 
 
 if __name__ == '__main__':
-    from snippets.lab4.example0_users import gc_user, gc_credentials_wrong
+    from snippets.lab4.example0_users import gc_user, gc_credentials_wrong, gc_token
 
     request = Request(
         name='my_function',
@@ -179,10 +514,27 @@ if __name__ == '__main__':
             ["a string", 42, 3.14, True, False], # a list, containing various primitive types
             {'key': 'value'}, # a dictionary
             Response(None, 'an error'), # a Response, which contains a None field
-        )
+            gc_token, # a Token, which contains a datetime
+            timedelta(days=1, microseconds=1), # a timedelta
+        ),
+        id=1,
     )
     serialized = serialize(request)
     print("Serialized", "=", serialized)
     deserialized = deserialize(serialized)
     print("Deserialized", "=", deserialized)
     assert request == deserialized
+
+    batch = BatchRequest([request, Request('another_function', ())])
+    assert batch == deserialize(serialize(batch))
+
+    serialized = serialize(request, BINARY)
+    print("Serialized (binary)", "=", serialized)
+    assert request == deserialize(serialized)
+    print(f"Binary message is {len(serialized)} bytes long, JSON one is {len(serialize(request).encode())} bytes long")
+
+    assert request == deserialize(serialize(request, JsonCodec(indent=None)))
+    try:
+        deserialize(serialized[:-1])
+    except ValueError as e:
+        assert str(e).startswith('Malformed binary message')
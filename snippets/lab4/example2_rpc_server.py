@@ -1,19 +1,104 @@
 from snippets.lab3 import Server
-from snippets.lab4.users.impl import InMemoryUserDatabase
-from snippets.lab4.example1_presentation import serialize, deserialize, Request, Response
+from snippets.lab4.users import UserDatabase, AuthenticationService
+from snippets.lab4.users.impl import InMemoryUserDatabase, InMemoryAuthenticationService
+from snippets.lab4.example1_presentation import serialize, deserialize, detect_codec, Request, Response, StreamItem, BatchRequest, BatchResponse, RESPONSE_TOO_LARGE
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator
+import os
+import threading
 import traceback
 
 
+class Dispatcher:
+    """
+    Strategy for executing request handlers: the default one runs them inline,
+    i.e. on the thread which received the request.
+    """
+
+    def dispatch(self, function, *args):
+        function(*args)
+
+    def close(self):
+        pass
+
+
+class PoolDispatcher(Dispatcher):
+    """
+    Runs handlers on an executor, so that slow requests do not hold the connection they came from.
+    At most `max_pending` handlers can be queued or running at the same time:
+    when the limit is reached, `dispatch` blocks, hence receiving threads stop reading from their connections,
+    and clients are eventually slowed down by TCP flow control (i.e. backpressure).
+    With a reactor, the receiving thread is an event loop: while `dispatch` blocks, all connections of that loop stall.
+    The executor must run handlers in this process (e.g. a thread pool), as handlers are bound to servers and sockets,
+    which cannot be sent to other processes: see `MultiProcessServer` for spreading requests among processes.
+    """
+
+    def __init__(self, executor: Executor, max_pending: int):
+        if isinstance(executor, ProcessPoolExecutor):
+            raise ValueError("Handlers cannot be run by process pools, as they are bound to sockets")
+        self.__executor = executor
+        self.__slots = threading.BoundedSemaphore(max_pending)
+
+    def dispatch(self, function, *args):
+        self.__slots.acquire()
+        try:
+            future = self.__executor.submit(function, *args)
+        except BaseException:
+            self.__slots.release()
+            raise
+        future.add_done_callback(self.__on_done)
+
+    def __on_done(self, future):
+        self.__slots.release()
+        if not future.cancelled() and future.exception() is not None: # queued handlers are cancelled upon closing
+            traceback.print_exception(future.exception())
+
+    def close(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ThreadPoolDispatcher(PoolDispatcher):
+    def __init__(self, workers: int = None, max_pending: int = None):
+        workers = workers or min(32, (os.cpu_count() or 1) + 4) # same default as ThreadPoolExecutor
+        super().__init__(ThreadPoolExecutor(workers, thread_name_prefix='rpc-worker'), max_pending or 4 * workers)
+
+
+PUBLIC_METHODS = frozenset({
+    'add_user', 'get_user', 'check_password', 'remove_user',
+    'get_users_by_role', 'get_users_by_email_domain', 'get_users_by_username_prefix',
+    'authenticate', 'validate_token',
+})
+
+
 class ServerStub(Server):
-    def __init__(self, port):
-        super().__init__(port, self.__on_connection_event)
-        self.__user_db = InMemoryUserDatabase()
+    def __init__(self, port, reactor=None, keep_alive=False, dispatcher: Dispatcher = None,
+                 user_db: UserDatabase = None, auth_service: AuthenticationService = None, reuse_port=False, on_change=None,
+                 methods=PUBLIC_METHODS):
+        """
+        Requests are handled by the given dispatcher, or inline (i.e. on the thread which received them) by default.
+        With a reactor, they are handled by a thread pool by default instead, as inline handlers would run on its
+        event loops, hence slow requests (e.g. hashing passwords) would delay all connections of their loop.
+        Unless provided, an empty in-memory user database is created, along with an authentication service using it.
+        The IDs of users added or removed by the requests handled are notified to subscribers,
+        or passed to `on_change` if given (e.g. to let another server notify its own subscribers).
+        Clients may only call the given methods (e.g. `add_hashed_user` is meant for replication servers only).
+        """
+        self.__user_db = InMemoryUserDatabase() if user_db is None else user_db
+        self.__auth_service = InMemoryAuthenticationService(self.__user_db) if auth_service is None else auth_service
+        self.__keep_alive = keep_alive # if set, connections are left open for clients to send further requests
+        self.__dispatcher = dispatcher or (Dispatcher() if reactor is None else ThreadPoolDispatcher())
+        self.__subscribers: dict = {} # connections to be notified about changes, along with their subscription
+        self.__subscribers_lock = threading.Lock()
+        self.__on_change = on_change or self.notify_change
+        self.__methods = frozenset(name for name in methods if not name.startswith('_'))
+        super().__init__(port, self.__on_connection_event, reactor, reuse_port=reuse_port) # starts serving right away
     
     def __on_connection_event(self, event, connection, address, error):
         match event:
             case 'listen':
                 print('Server listening on %s:%d' % address)
             case 'connect':
+                connection.text = False # messages may be either JSON or binary
                 connection.callback = self.__on_message_event
             case 'error':
                 traceback.print_exception(error)
@@ -24,35 +109,144 @@ class ServerStub(Server):
         match event:
             case 'message':
                 print('[%s:%d] Open connection' % connection.remote_address)
-                request = deserialize(payload)
-                assert isinstance(request, Request)
-                print('[%s:%d] Unmarshall request:' % connection.remote_address, request)
-                response = self.__handle_request(request)
-                connection.send(serialize(response))
-                print('[%s:%d] Marshall response:' % connection.remote_address, response)
-                connection.close()
+                self.__dispatcher.dispatch(self.__serve, payload, connection)
             case 'error':
                 traceback.print_exception(error)
             case 'close':
+                with self.__subscribers_lock:
+                    self.__subscribers.pop(connection, None)
                 print('[%s:%d] Close connection' % connection.remote_address)
     
+    def __serve(self, payload, connection):
+        try:
+            self.__respond(payload, connection)
+        except Exception:
+            connection.close() # the client would otherwise wait for a response forever
+            raise
+
+    def __respond(self, payload, connection):
+        codec = detect_codec(payload) # responses are encoded in the same way requests are
+        request = deserialize(payload)
+        assert isinstance(request, (Request, BatchRequest))
+        print('[%s:%d] Unmarshall request:' % connection.remote_address, request)
+        if isinstance(request, Request) and request.name == 'subscribe':
+            self.__subscribe(connection, request, codec)
+            return # subscriptions are never closed by the server
+        if isinstance(request, Request) and request.stream:
+            for response in self.__handle_stream_request(request):
+                if not self.__send(connection, response, codec):
+                    break
+        else:
+            response = self.__handle_request(request)
+            self.__send(connection, response, codec)
+        print('[%s:%d] Marshall response:' % connection.remote_address, response)
+        if not self.__keep_alive:
+            connection.close()
+
+    def close(self):
+        super().close()
+        self.__dispatcher.close()
+
+    def __send(self, connection, response, codec) -> bool:
+        """
+        Sends the response, unless it does not fit into a frame: then, an error is sent in its place
+        (e.g. for clients to split batches, or to stream query results), and False is returned.
+        """
+        message = serialize(response, codec)
+        if isinstance(message, str):
+            message = message.encode('utf-8') # frames are limited in bytes
+        if len(message) <= connection.framing.max_frame_size:
+            connection.send(message)
+            return True
+        error = f"{RESPONSE_TOO_LARGE} ({len(message)} bytes, at most {connection.framing.max_frame_size} allowed)"
+        connection.send(serialize(Response(None, error, response.id), codec))
+        return False
+
+    def __subscribe(self, connection, request, codec):
+        """
+        From now on, whenever users are added or removed, the IDs they are stored under are sent to the connection,
+        as StreamItems carrying the ID of the subscription request.
+        An empty notification is sent right away, to let the client know the subscription is active.
+        """
+        with self.__subscribers_lock:
+            self.__subscribers[connection] = (request.id, codec)
+            connection.send(serialize(StreamItem([], request.id), codec))
+        print('[%s:%d] Subscribed to changes' % connection.remote_address)
+
+    def notify_change(self, ids):
+        with self.__subscribers_lock:
+            subscribers = list(self.__subscribers.items())
+        for connection, (id, codec) in subscribers:
+            try:
+                connection.send(serialize(StreamItem(sorted(ids), id), codec))
+            except (OSError, ConnectionError):
+                with self.__subscribers_lock:
+                    self.__subscribers.pop(connection, None)
+
+    def __find_method(self, name):
+        if name not in self.__methods:
+            raise AttributeError(f"No such method: {name}")
+        for service in (self.__user_db, self.__auth_service):
+            if hasattr(service, name):
+                return getattr(service, name)
+        raise AttributeError(f"No such method: {name}")
+
     def __handle_request(self, request):
+        if isinstance(request, BatchRequest):
+            return BatchResponse([self.__handle_request(r) for r in request.requests], request.id)
         try:
-            method = getattr(self.__user_db, request.name)
+            method = self.__find_method(request.name)
             result = method(*request.args)
+            if isinstance(result, Iterator): # e.g. query results, unless streamed
+                result = list(result)
             error = None
         except Exception as e:
             result = None
             error = " ".join(e.args)
-        return Response(result, error)
+        if error is None and request.name in ('add_user', 'add_hashed_user'):
+            self.__on_change(request.args[0].ids)
+        elif error is None and request.name == 'remove_user':
+            self.__on_change(result.ids)
+        return Response(result, error, request.id)
+
+    def __handle_stream_request(self, request):
+        try:
+            method = self.__find_method(request.name)
+            for item in method(*request.args):
+                yield StreamItem(item, request.id)
+            error = None
+        except Exception as e:
+            error = " ".join(e.args)
+        yield Response(None, error, request.id)
 
 
 if __name__ == '__main__':
-    import sys
-    server = ServerStub(int(sys.argv[1]))
+    from snippets.lab3.reactor import Reactor
+    from snippets.lab4.users.persistent import PersistentUserDatabase
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=f'python -m snippets -l 4 -e 2',
+        description='RPC server for user database',
+        exit_on_error=False,
+    )
+    parser.add_argument('port', type=int, help='Port to listen on')
+    parser.add_argument('--reactor', '-R', type=int, metavar='WORKERS', help='Serve connections via a reactor with the given amount of worker threads, rather than one thread per connection')
+    parser.add_argument('--keep-alive', '-k', action='store_true', help='Keep connections open after responding, for clients to reuse them')
+    parser.add_argument('--workers', '-w', type=int, help='Handle requests via a pool with the given amount of worker threads, rather than on the receiving thread (with a reactor, a pool is used anyway)')
+    parser.add_argument('--max-pending', '-p', type=int, help='Maximum amount of requests queued or running on the worker pool, before receiving threads stop reading (defaults to 4 per worker)')
+    parser.add_argument('--data', '-d', metavar='DIRECTORY', help='Persist users in the given directory, recovering them at startup')
+    args = parser.parse_args()
+
+    reactor = Reactor(args.reactor) if args.reactor else None
+    dispatcher = ThreadPoolDispatcher(args.workers, args.max_pending) if args.workers else None
+    user_db = PersistentUserDatabase(args.data) if args.data else None
+    server = ServerStub(args.port, reactor, args.keep_alive, dispatcher, user_db)
     while True:
         try:
             input('Close server with Ctrl+D (Unix) or Ctrl+Z (Win)\n')
         except (EOFError, KeyboardInterrupt):
             break
     server.close()
+    if user_db is not None:
+        user_db.close()
@@ -1,47 +1,445 @@
-from snippets.lab3 import Client, address
+from snippets.lab3 import Client, ConnectionPool, DEFAULT_FRAMING, address
 from snippets.lab4.users import *
-from snippets.lab4.example1_presentation import serialize, deserialize, Request, Response
+from snippets.lab4.example1_presentation import serialize, deserialize, detect_codec, Codec, JSON, BINARY, Request, Response, StreamItem, BatchRequest, BatchResponse, RESPONSE_TOO_LARGE
+from collections import OrderedDict
+from concurrent.futures import Future
+from queue import SimpleQueue
+from typing import Iterable, Iterator
+import itertools
+import threading
+import time
+
+
+DEFAULT_BATCH_SIZE = 100 # maximum amount of calls per batch (batches are split further if they do not fit into a frame)
+
+
+def printable(message: str | bytes) -> str:
+    if isinstance(message, bytes) and detect_codec(message) is not BINARY:
+        message = message.decode('utf-8') # JSON is shown as text
+    return message.replace('\n', '\n# ') if isinstance(message, str) else repr(message)
 
 
 class ClientStub:
-    def __init__(self, server_address: tuple[str, int]):
+    def __init__(self, server_address: tuple[str, int], pool: ConnectionPool = None, codec: Codec = None):
+        """
+        If a pool is provided, connections are kept alive and reused across calls
+        (which requires the server to keep connections alive as well).
+        Otherwise, a new connection is opened (and closed) for each call.
+        Requests are encoded via the given codec (JSON by default), and the server responds with the same codec.
+        """
         self.__server_address = address(*server_address)
+        self.__pool = pool
+        self.__codec = codec or JSON
+
+    @property
+    def codec(self) -> Codec:
+        return self.__codec
+
+    @property
+    def server_address(self) -> tuple[str, int]:
+        return self.__server_address
 
     def rpc(self, name, *args):
-        client = Client(self.__server_address)
+        response = self._call(Request(name, args))
+        assert isinstance(response, Response)
+        if response.error:
+            raise RuntimeError(response.error)
+        return response.result
+
+    def rpc_batch(self, name, args: Iterable[tuple], batch_size: int = DEFAULT_BATCH_SIZE) -> list:
+        """
+        Calls the same function once per arguments tuple, sending up to `batch_size` calls per message.
+        Returns the results in order, or raises an error as soon as one call fails
+        (calls preceding the failed one, in the same batch or in previous ones, are executed anyway).
+        """
+        results = []
+        args = iter(args)
+        while batch := list(itertools.islice(args, batch_size)):
+            for item in self.__call_batch([Request(name, a) for a in batch]):
+                if item.error:
+                    raise RuntimeError(item.error)
+                results.append(item.result)
+        return results
+
+    def __call_batch(self, requests: list[Request]) -> list[Response]:
+        """
+        Sends the given calls in one message, unless it would exceed the maximum frame size: then, each half is sent on its own.
+        The same happens if the server cannot fit the responses into a frame, in which case calls are executed again
+        (only results of queries may be that large, so this is harmless).
+        """
+        batch = BatchRequest(requests, self._new_request_id())
+        message = serialize(batch, self.__codec)
+        if isinstance(message, str):
+            message = message.encode('utf-8') # frames are limited in bytes
+        framing = self.__pool.framing if self.__pool is not None else DEFAULT_FRAMING
+        half = len(requests) // 2
+        if len(message) > framing.max_frame_size and half > 0:
+            return self.__call_batch(requests[:half]) + self.__call_batch(requests[half:])
+        try:
+            response = self._call(batch, message)
+            if isinstance(response, Response): # the batch failed as a whole
+                raise RuntimeError(response.error)
+        except RuntimeError as e:
+            if half == 0 or not str(e).startswith(RESPONSE_TOO_LARGE):
+                raise
+            return self.__call_batch(requests[:half]) + self.__call_batch(requests[half:])
+        assert isinstance(response, BatchResponse)
+        return response.responses
+
+    def rpc_stream(self, name, *args) -> Iterator:
+        """
+        Calls a function returning many items, which are yielded one by one, as soon as they arrive.
+        This way, items can be used before the whole result is received, and they never need to be in memory all together.
+        """
+        request = Request(name, args, stream=True)
+        if self.__pool is None:
+            client = Client(self.__server_address)
+            try:
+                print('# Connected to %s:%d' % client.remote_address)
+                yield from self.__exchange_stream(client, request)
+            finally:
+                client.close()
+                print('# Disconnected from %s:%d' % client.remote_address)
+        else:
+            with self.__pool.connection() as client: # connections are not reused if the stream is not consumed entirely
+                yield from self.__exchange_stream(client, request)
+
+    def __exchange_stream(self, client: Client, request: Request) -> Iterator:
+        response = self.__exchange(client, request)
+        while isinstance(response, StreamItem):
+            yield response.item
+            response = self.__receive(client)
+        assert isinstance(response, Response)
+        if response.error:
+            raise RuntimeError(response.error)
+
+    def _new_request_id(self) -> int | None:
+        """ID of the next request: only needed to match responses to requests in flight on the same connection"""
+        return None
+
+    def _call(self, request: Request | BatchRequest, message: bytes = None) -> Response | BatchResponse:
+        if self.__pool is None:
+            client = Client(self.__server_address)
+            try:
+                print('# Connected to %s:%d' % client.remote_address)
+                return self.__exchange(client, request, message)
+            finally:
+                client.close()
+                print('# Disconnected from %s:%d' % client.remote_address)
+        with self.__pool.connection() as client:
+            return self.__exchange(client, request, message)
+
+    def __exchange(self, client: Client, request: Request | BatchRequest, message: bytes = None):
+        """The request is marshalled, unless its message is given"""
+        print('# Marshalling', request, 'towards', "%s:%d" % client.remote_address)
+        if message is None:
+            message = serialize(request, self.__codec)
+        print('# Sending message:', printable(message))
+        client.text = False # responses may be either JSON or binary
+        client.send(message)
+        return self.__receive(client)
+
+    def __receive(self, client: Client) -> Response | BatchResponse | StreamItem:
+        message = client.receive()
+        if message is None:
+            raise ConnectionError("Connection closed by %s:%d before responding" % client.remote_address)
+        print('# Received message:', printable(message))
+        response = deserialize(message)
+        assert isinstance(response, (Response, BatchResponse, StreamItem))
+        print('# Unmarshalled', response, 'from', "%s:%d" % client.remote_address)
+        return response
+
+
+class MultiplexedClientStub(ClientStub):
+    """
+    Sends all calls over one persistent connection, without waiting for previous calls to be answered.
+    Each request (or batch of requests) carries an ID, which the server copies in the corresponding response
+    (and stream items): this is how they are matched with pending calls, in whichever order they arrive.
+    Items of streamed calls are queued until consumed, as the connection is shared with all other calls
+    (hence, unlike with `ClientStub`, slow consumers do not slow down the server).
+    Requires the server to keep connections alive.
+    """
+
+    def __init__(self, server_address: tuple[str, int], *args, **kwargs):
+        super().__init__(server_address, *args, **kwargs)
+        self.__server_address = address(*server_address)
+        self.__client: Client | None = None
+        self.__ids = itertools.count()
+        # pending calls, along with the connection they were sent on: futures of single calls (resolved with their result)
+        # or of batches (resolved with their BatchResponse), or queues of the responses to streamed calls
+        self.__calls: dict[int, tuple[Future | SimpleQueue, Client]] = {}
+        self.__lock = threading.Lock()
+
+    def _new_request_id(self) -> int:
+        return next(self.__ids)
+
+    def __send(self, request: Request | BatchRequest, pending: Future | SimpleQueue, message: bytes = None):
+        assert request.id is not None
+        with self.__lock:
+            if self.__client is None or self.__client.closed:
+                self.__client = Client(self.__server_address)
+                self.__client.text = False # responses may be either JSON or binary
+                self.__client.callback = self.__on_message_event
+                print('# Connected to %s:%d' % self.__client.remote_address)
+            client = self.__client
+            self.__calls[request.id] = (pending, client)
+        print('# Marshalling', request, 'towards', "%s:%d" % client.remote_address)
         try:
-            print('# Connected to %s:%d' % client.remote_address)
-            request = Request(name, args)
-            print('# Marshalling', request, 'towards', "%s:%d" % client.remote_address)
-            request = serialize(request)
-            print('# Sending message:', request.replace('\n', '\n# '))
-            client.send(request)
-            response = client.receive()
-            print('# Received message:', response.replace('\n', '\n# '))
-            response = deserialize(response)
-            assert isinstance(response, Response)
-            print('# Unmarshalled', response, 'from', "%s:%d" % client.remote_address)
+            client.send(serialize(request, self.codec) if message is None else message)
+        except Exception as e:
+            with self.__lock:
+                self.__calls.pop(request.id, None)
+            self.__fail(pending, e)
+
+    @staticmethod
+    def __fail(pending: Future | SimpleQueue, error: Exception):
+        if isinstance(pending, Future):
+            pending.set_exception(error)
+        else:
+            pending.put(error)
+
+    def rpc_async(self, name, *args) -> Future:
+        future: Future = Future()
+        self.__send(Request(name, args, self._new_request_id()), future)
+        return future
+
+    def rpc(self, name, *args):
+        return self.rpc_async(name, *args).result()
+
+    def _call(self, request: Request | BatchRequest, message: bytes = None) -> Response | BatchResponse:
+        assert isinstance(request, BatchRequest) # single calls go through `rpc_async`
+        future: Future = Future()
+        self.__send(request, future, message)
+        return future.result()
+
+    def rpc_stream(self, name, *args) -> Iterator:
+        responses: SimpleQueue = SimpleQueue()
+        self.__send(Request(name, args, self._new_request_id(), stream=True), responses)
+        while True:
+            response = responses.get()
+            if isinstance(response, Exception):
+                raise response
+            if isinstance(response, StreamItem):
+                yield response.item
+                continue
             if response.error:
                 raise RuntimeError(response.error)
-            return response.result
-        finally:
+            return
+
+    def __on_message_event(self, event, payload, connection, error):
+        match event:
+            case 'message':
+                response = deserialize(payload)
+                assert isinstance(response, (Response, BatchResponse, StreamItem))
+                print('# Unmarshalled', response, 'from', "%s:%d" % connection.remote_address)
+                with self.__lock:
+                    if response.id is None:
+                        pending = None
+                    elif isinstance(response, StreamItem): # further items, and a final response, follow
+                        pending, _ = self.__calls.get(response.id, (None, None))
+                    else:
+                        pending, _ = self.__calls.pop(response.id, (None, None))
+                if pending is None:
+                    print('# Ignoring response to unknown request', response.id)
+                elif isinstance(pending, SimpleQueue):
+                    pending.put(response)
+                elif isinstance(response, Response) and response.error:
+                    pending.set_exception(RuntimeError(response.error))
+                else:
+                    pending.set_result(response.result if isinstance(response, Response) else response)
+            case 'error':
+                print('# Error on connection to %s:%d:' % connection.remote_address, error)
+            case 'close':
+                print('# Disconnected from %s:%d' % connection.remote_address)
+                with self.__lock:
+                    aborted = [id for id, (_, client) in self.__calls.items() if client is connection]
+                    pending_calls = [self.__calls.pop(id)[0] for id in aborted]
+                for pending in pending_calls:
+                    self.__fail(pending, ConnectionError("Connection closed by %s:%d before responding" % connection.remote_address))
+
+    def close(self):
+        with self.__lock:
+            client, self.__client = self.__client, None
+        if client is not None:
             client.close()
-            print('# Disconnected from %s:%d' % client.remote_address)
 
 
 class RemoteUserDatabase(ClientStub, UserDatabase):
-    def __init__(self, server_address):
-        super().__init__(server_address)
+    def __init__(self, server_address, pool: ConnectionPool = None, codec: Codec = None):
+        super().__init__(server_address, pool, codec)
 
     def add_user(self, user: User):
         return self.rpc('add_user', user)
 
+    def add_hashed_user(self, user: User):
+        return self.rpc('add_hashed_user', user)
+
     def get_user(self, id: str) -> User:
         return self.rpc('get_user', id)
 
     def check_password(self, credentials: Credentials) -> bool:
         return self.rpc('check_password', credentials)
 
+    def remove_user(self, id: str) -> User:
+        return self.rpc('remove_user', id)
+
+    def add_users(self, users: Iterable[User], batch_size: int = DEFAULT_BATCH_SIZE):
+        self.rpc_batch('add_user', ((user,) for user in users), batch_size)
+
+    def get_users(self, ids: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE) -> list[User]:
+        return self.rpc_batch('get_user', ((id,) for id in ids), batch_size)
+
+    def get_users_by_role(self, role: Role, limit: int = None, after: str = None) -> Iterator[User]:
+        return self.rpc_stream('get_users_by_role', role, limit, after)
+
+    def get_users_by_email_domain(self, domain: str, limit: int = None, after: str = None) -> Iterator[User]:
+        return self.rpc_stream('get_users_by_email_domain', domain, limit, after)
+
+    def get_users_by_username_prefix(self, prefix: str, limit: int = None, after: str = None) -> Iterator[User]:
+        return self.rpc_stream('get_users_by_username_prefix', prefix, limit, after)
+
+
+class MultiplexedRemoteUserDatabase(MultiplexedClientStub, RemoteUserDatabase):
+    pass
+
+
+class CachedRemoteUserDatabase(RemoteUserDatabase):
+    """
+    Serves repeated `get_user` calls locally, via a cache of up to `size` entries, each one living up to `ttl` seconds.
+    Since a user can be retrieved via several IDs, each cached user is stored once, and reachable via all its IDs.
+    Missing users are cached as well, along with the error raised when looking for them.
+    If `subscribe` is set, the server is asked to notify changes to users,
+    and affected entries are invalidated as soon as notifications arrive.
+    Servers notify the writes they apply: a `MultiProcessServer` notifies all writes to any worker,
+    while each node of a `DistributedUserDatabase` only notifies the writes of the users it stores,
+    hence clients caching users of several nodes need a cache (i.e. a subscription) per node.
+    Cached users are shared among callers, which should not modify them.
+    """
+
+    def __init__(self, server_address, pool: ConnectionPool = None, codec: Codec = None,
+                 size: int = 1024, ttl: float = 60.0, subscribe: bool = True):
+        super().__init__(server_address, pool, codec)
+        self.__size = size
+        self.__ttl = ttl
+        self.__entries: OrderedDict[str, tuple[User | str, float, set[str]]] = OrderedDict() # LRU order, key -> (user or error, expiration, IDs)
+        self.__keys: dict[str, str] = {} # ID -> key of the entry
+        self.__version = 0 # incremented at each invalidation, to discard responses which may be outdated
+        self.__lock = threading.Lock()
+        self.__subscription: Client | None = None
+        self.__subscription_lock = threading.Lock()
+        self.__subscribed = threading.Event()
+        self.__subscribe = subscribe
+
+    def get_user(self, id: str) -> User:
+        if self.__subscribe:
+            self.__ensure_subscribed()
+        with self.__lock:
+            key = self.__keys.get(id)
+            if key is not None:
+                value, expiration, _ = self.__entries[key]
+                if expiration > time.monotonic():
+                    self.__entries.move_to_end(key)
+                    if isinstance(value, str):
+                        raise RuntimeError(value)
+                    return value
+                self.__evict(key)
+            version = self.__version
+        try:
+            user = super().get_user(id)
+            self.__store(version, user.username, user, user.ids)
+            return user
+        except RuntimeError as e:
+            self.__store(version, id, str(e), {id})
+            raise
+
+    def remove_user(self, id: str) -> User:
+        user = super().remove_user(id)
+        self.invalidate(user.ids) # without waiting for the notification
+        return user
+
+    def __store(self, version: int, key: str, value: User | str, ids: set[str]):
+        with self.__lock:
+            if version != self.__version:
+                return # an invalidation arrived in the meanwhile
+            if key in self.__entries:
+                self.__evict(key)
+            for id in ids:
+                if id in self.__keys:
+                    self.__evict(self.__keys[id])
+            self.__entries[key] = (value, time.monotonic() + self.__ttl, ids)
+            for id in ids:
+                self.__keys[id] = key
+            while len(self.__entries) > self.__size:
+                self.__evict(next(iter(self.__entries)))
+
+    def __evict(self, key: str):
+        _, _, ids = self.__entries.pop(key)
+        for id in ids:
+            if self.__keys.get(id) == key:
+                del self.__keys[id]
+
+    def invalidate(self, ids: Iterable[str] = None):
+        """Drops the entries of the given IDs, or all entries if no ID is given"""
+        with self.__lock:
+            self.__version += 1
+            if ids is None:
+                self.__entries.clear()
+                self.__keys.clear()
+                return
+            for id in ids:
+                if id in self.__keys:
+                    self.__evict(self.__keys[id])
+
+    def __ensure_subscribed(self):
+        with self.__subscription_lock: # only one thread subscribes, the others wait for it
+            if self.__subscription is not None and not self.__subscription.closed:
+                return
+            self.__subscribed.clear()
+            client = Client(self.server_address)
+            client.text = False # notifications may be either JSON or binary
+            client.callback = self.__on_notification
+            client.send(serialize(Request('subscribe', (), stream=True), self.codec))
+            if not self.__subscribed.wait(self.__ttl):
+                client.close()
+                raise ConnectionError("Subscription not confirmed by %s:%d" % client.remote_address)
+            self.__subscription = client
+        self.invalidate() # changes occurred while not subscribed went unnoticed
+
+    def __on_notification(self, event, payload, connection, error):
+        match event:
+            case 'message':
+                notification = deserialize(payload)
+                assert isinstance(notification, StreamItem)
+                if notification.item:
+                    print('# Invalidating cached users with IDs', notification.item)
+                    self.invalidate(notification.item)
+                self.__subscribed.set()
+            case 'close':
+                self.invalidate() # changes occurring from now on would go unnoticed
+
+    def close(self):
+        with self.__subscription_lock:
+            subscription, self.__subscription = self.__subscription, None
+            self.__subscribe = False
+        if subscription is not None:
+            subscription.close()
+
+
+class RemoteAuthenticationService(ClientStub, AuthenticationService):
+    """
+    Tokens are issued by the server, and can be validated remotely on each request:
+    expiration dates travel as datetimes, so tokens cross the wire unchanged.
+    """
+
+    def __init__(self, server_address, pool: ConnectionPool = None, codec: Codec = None):
+        super().__init__(server_address, pool, codec)
+
+    def authenticate(self, credentials: Credentials, duration: timedelta = None) -> Token:
+        return self.rpc('authenticate', credentials, duration)
+
+    def validate_token(self, token: Token) -> bool:
+        return self.rpc('validate_token', token)
+
 
 if __name__ == '__main__':
     from snippets.lab4.example0_users import gc_user, gc_credentials_ok, gc_credentials_wrong
@@ -75,3 +473,19 @@ if __name__ == '__main__':
 
     # Checking credentials should fail if the password is wrong
     assert user_db.check_password(gc_credentials_wrong) == False
+
+    auth_service = RemoteAuthenticationService(address(sys.argv[1]))
+
+    # Authenticating with wrong credentials should fail
+    try:
+        auth_service.authenticate(gc_credentials_wrong)
+    except RuntimeError as e:
+        assert 'Invalid credentials' in str(e)
+
+    # Tokens issued remotely should be valid when validated remotely
+    gc_token = auth_service.authenticate(gc_credentials_ok[0])
+    assert gc_token.user == gc_user.copy(password=None)
+    assert auth_service.validate_token(gc_token) == True
+
+    # Tampered tokens should be invalid
+    assert auth_service.validate_token(gc_token.copy(expiration=gc_token.expiration + timedelta(days=1))) == False
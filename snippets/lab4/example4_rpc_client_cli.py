@@ -1,4 +1,5 @@
 from .example3_rpc_client import *
+from .example1_presentation import CODECS
 import argparse
 import sys
 
@@ -11,12 +12,17 @@ if __name__ == '__main__':
         exit_on_error=False,
     )
     parser.add_argument('address', help='Server address in the form ip:port')
-    parser.add_argument('command', help='Method to call', choices=['add', 'get', 'check'])
+    parser.add_argument('command', help='Method to call', choices=['add', 'get', 'check', 'find'])
     parser.add_argument('--user', '-u', help='Username')
     parser.add_argument('--email', '--address', '-a', nargs='+', help='Email address')
     parser.add_argument('--name', '-n', help='Full name')
     parser.add_argument('--role', '-r', help='Role (defaults to "user")', choices=['admin', 'user'])
     parser.add_argument('--password', '-p', help='Password')
+    parser.add_argument('--domain', '-d', help='Email domain of the users to find')
+    parser.add_argument('--prefix', help='Username prefix of the users to find')
+    parser.add_argument('--limit', '-l', type=int, help='Maximum amount of users to find')
+    parser.add_argument('--after', help='Only find users whose username follows this one (i.e. the last one of the previous page)')
+    parser.add_argument('--codec', '-c', help='Encoding of messages (defaults to "json")', choices=list(CODECS), default='json')
 
     if len(sys.argv) > 1:
         args = parser.parse_args()
@@ -25,9 +31,21 @@ if __name__ == '__main__':
         sys.exit(0)
 
     args.address = address(args.address)
-    user_db = RemoteUserDatabase(args.address)
+    user_db = RemoteUserDatabase(args.address, codec=CODECS[args.codec])
 
     try :
+        if args.command == 'find':
+            if args.role:
+                users = user_db.get_users_by_role(Role[args.role.upper()], args.limit, args.after)
+            elif args.domain:
+                users = user_db.get_users_by_email_domain(args.domain, args.limit, args.after)
+            elif args.prefix is not None:
+                users = user_db.get_users_by_username_prefix(args.prefix, args.limit, args.after)
+            else:
+                raise ValueError("Either role, domain or prefix is required")
+            for user in users:
+                print(user)
+            sys.exit(0)
         ids = (args.email or []) + [args.user]
         if len(ids) == 0:
             raise ValueError("Username or email address is required")
@@ -0,0 +1,156 @@
+from snippets.lab3 import ConnectionPool
+from snippets.lab4.users import *
+from snippets.lab4.users.impl import InMemoryUserDatabase, InMemoryAuthenticationService
+from snippets.lab4.example2_rpc_server import ServerStub, PUBLIC_METHODS
+from snippets.lab4.example3_rpc_client import RemoteUserDatabase
+import multiprocessing
+import threading
+import uuid
+
+
+class ReplicatedUserDatabase(UserDatabase):
+    """
+    A replica of a user database shared by several processes.
+    Reads are served by the local replica, hence they scale with the amount of processes.
+    Writes are forwarded to the primary replica, which applies them locally (hence checking for duplicate IDs),
+    and then to all other replicas, one write at a time, before responding:
+    this way, all replicas apply the same writes in the same order,
+    and clients can read their own writes from any replica.
+    Passwords are hashed once, by the primary replica, before taking the write lock:
+    other replicas receive the already-hashed user.
+    """
+
+    def __init__(self, local: InMemoryUserDatabase, primary: RemoteUserDatabase = None):
+        """
+        Other replicas are given the primary one, while the primary one is given all others via `add_replica`.
+        """
+        self.__local = local
+        self.__primary = primary
+        self.__replicas: list[RemoteUserDatabase] = []
+        self.__write_lock = threading.Lock()
+
+    def add_replica(self, replica: RemoteUserDatabase):
+        with self.__write_lock:
+            self.__replicas.append(replica)
+
+    def add_user(self, user: User):
+        if self.__primary is not None:
+            return self.__primary.add_user(user)
+        if user.password is None:
+            raise ValueError("Password digest is required")
+        user = user.copy(password=self.__local.hasher.hash(user.password))
+        with self.__write_lock:
+            self.__local.add_hashed_user(user)
+            for replica in self.__replicas:
+                replica.add_hashed_user(user)
+
+    def remove_user(self, id: str) -> User:
+        if self.__primary is not None:
+            return self.__primary.remove_user(id)
+        with self.__write_lock:
+            user = self.__local.remove_user(id)
+            for replica in self.__replicas:
+                replica.remove_user(id)
+            return user
+
+    def get_user(self, id: str) -> User:
+        return self.__local.get_user(id)
+
+    def check_password(self, credentials: Credentials) -> bool:
+        return self.__local.check_password(credentials)
+
+
+def _remote_replica(port) -> RemoteUserDatabase:
+    server_address = ('localhost', port)
+    return RemoteUserDatabase(server_address, ConnectionPool(server_address))
+
+
+def _run_worker(index: int, port: int, secret: str, ports: multiprocessing.Queue, replica_ports, reactor_workers: int = None):
+    """
+    Entry point of worker processes: worker 0 hosts the primary replica.
+    Each worker exposes its replica on a private port (used for replication),
+    and the whole database on the public port, which is shared among all workers.
+    Subscribers of each worker are notified about writes once its replica applies them, i.e. upon replication,
+    but for writes applied by the primary replica on behalf of its public server, which notifies them itself.
+    """
+    from snippets.lab3.reactor import Reactor
+
+    local = InMemoryUserDatabase()
+    user_db = ReplicatedUserDatabase(local) if index == 0 else local # writes forwarded to the primary are replicated
+    public_servers: list[ServerStub] = [] # filled once the public server is started
+    def notify_public(ids):
+        for public_server in public_servers:
+            public_server.notify_change(ids)
+    replication_server = ServerStub(0, keep_alive=True, user_db=user_db, on_change=notify_public, # ephemeral port
+                                    methods=PUBLIC_METHODS | {'add_hashed_user'})
+    ports.put((index, replication_server.local_address[1]))
+    primary_port, *other_ports = replica_ports.get() # blocks until all workers are ready
+    if isinstance(user_db, ReplicatedUserDatabase):
+        for other_port in other_ports:
+            user_db.add_replica(_remote_replica(other_port))
+    else:
+        user_db = ReplicatedUserDatabase(local, primary=_remote_replica(primary_port))
+    auth_service = InMemoryAuthenticationService(user_db, secret) # tokens issued by any worker are valid for all workers
+    reactor = Reactor(reactor_workers) if reactor_workers else None
+    on_change = None if index == 0 else lambda ids: None # other workers are notified about their writes upon replication
+    server = ServerStub(port, reactor, keep_alive=True, user_db=user_db, auth_service=auth_service, reuse_port=True,
+                        on_change=on_change)
+    public_servers.append(server)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        replication_server.close()
+
+
+class MultiProcessServer:
+    """
+    Serves the same port via several worker processes, each one with its own replica of the user database,
+    in order for request handling to scale with the amount of cores (instead of being limited by the GIL).
+    Incoming connections are balanced among workers by the OS (via SO_REUSEPORT).
+    """
+
+    def __init__(self, port: int, workers: int = None, reactor_workers: int = None):
+        workers = workers or multiprocessing.cpu_count()
+        secret = str(uuid.uuid4())
+        ports: multiprocessing.Queue = multiprocessing.Queue()
+        queues: list[multiprocessing.Queue] = [multiprocessing.Queue() for _ in range(workers)]
+        self.__processes = [
+            multiprocessing.Process(target=_run_worker, args=(i, port, secret, ports, queues[i], reactor_workers), daemon=True)
+            for i in range(workers)
+        ]
+        for process in self.__processes:
+            process.start()
+        replica_ports = [port for _, port in sorted(ports.get() for _ in range(workers))]
+        for queue in queues:
+            queue.put(replica_ports)
+
+    def close(self):
+        for process in self.__processes:
+            process.terminate()
+        for process in self.__processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=f'python -m snippets -l 4 -e 5',
+        description='RPC server for user database, running on several processes',
+        exit_on_error=False,
+    )
+    parser.add_argument('port', type=int, help='Port to listen on')
+    parser.add_argument('--workers', '-w', type=int, help='Amount of worker processes (defaults to the amount of cores)')
+    parser.add_argument('--reactor', '-R', type=int, metavar='THREADS', help='Serve connections via a reactor with the given amount of threads in each worker, rather than one thread per connection')
+    args = parser.parse_args()
+
+    server = MultiProcessServer(args.port, args.workers, args.reactor)
+    while True:
+        try:
+            input('Close server with Ctrl+D (Unix) or Ctrl+Z (Win)\n')
+        except (EOFError, KeyboardInterrupt):
+            break
+    server.close()
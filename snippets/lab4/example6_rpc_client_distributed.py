@@ -0,0 +1,180 @@
+from snippets.lab3 import ConnectionPool, address
+from snippets.lab4.users import *
+from snippets.lab4.example1_presentation import Codec
+from snippets.lab4.example3_rpc_client import RemoteUserDatabase
+from concurrent.futures import ThreadPoolExecutor, wait
+import bisect
+import hashlib
+
+
+class HashRing:
+    """
+    Consistent hashing: both nodes and keys are hashed on a ring, and each key belongs to the first nodes following it.
+    Each node is placed on the ring several times (i.e. virtual nodes), for keys to be evenly spread among nodes.
+    Adding or removing a node only moves the keys of its neighbours.
+    """
+
+    def __init__(self, nodes=(), virtual_nodes: int = 64):
+        self.__virtual_nodes = virtual_nodes
+        self.__hashes: list[int] = [] # sorted
+        self.__nodes: list = [] # node of each hash
+        self.__count = 0
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def __hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def __len__(self):
+        return self.__count
+
+    def add(self, node):
+        for i in range(self.__virtual_nodes):
+            h = self.__hash(f'{node}#{i}')
+            index = bisect.bisect(self.__hashes, h)
+            self.__hashes.insert(index, h)
+            self.__nodes.insert(index, node)
+        self.__count += 1
+
+    def remove(self, node):
+        kept = [(h, n) for h, n in zip(self.__hashes, self.__nodes) if n != node]
+        self.__hashes = [h for h, _ in kept]
+        self.__nodes = [n for _, n in kept]
+        self.__count -= 1
+
+    def nodes_for(self, key: str, count: int = 1) -> list:
+        """The first `count` distinct nodes following the key on the ring, i.e. the replicas of the key"""
+        result: list = []
+        if not self.__hashes:
+            return result
+        start = bisect.bisect(self.__hashes, self.__hash(key))
+        for i in range(len(self.__hashes)):
+            node = self.__nodes[(start + i) % len(self.__nodes)]
+            if node not in result:
+                result.append(node)
+                if len(result) == min(count, self.__count):
+                    break
+        return result
+
+
+class DistributedUserDatabase(UserDatabase):
+    """
+    Spreads users among several servers via consistent hashing, each ID being stored by `replicas` servers.
+    As a user is indexed under several IDs (username and emails), it is written on the replicas of each of its IDs,
+    in order for it to be found by whichever ID is used.
+    Writes succeed if acknowledged by at least `write_quorum` replicas of each ID (a majority, by default),
+    while reads are served by any replica of the given ID (the first one which knows the ID).
+    If a write fails (e.g. because some replica already stores one of the IDs), the user is removed again
+    from the replicas which stored it, in order for it not to be left partially written.
+    Removal is best effort: replicas which are unreachable at that time keep the user.
+    """
+
+    def __init__(self, server_addresses, replicas: int = 3, write_quorum: int = None, codec: Codec = None):
+        self.__nodes = {
+            node: RemoteUserDatabase(node, ConnectionPool(node), codec)
+            for node in (address(*server_address) for server_address in server_addresses)
+        }
+        self.__ring = HashRing(self.__nodes)
+        self.__replicas = min(replicas, len(self.__nodes))
+        self.__write_quorum = write_quorum or self.__replicas // 2 + 1
+        if not 0 < self.__write_quorum <= self.__replicas:
+            raise ValueError(f"Write quorum must be between 1 and {self.__replicas}")
+        self.__executor = ThreadPoolExecutor(max(len(self.__nodes), 1), thread_name_prefix='distributed-db')
+
+    def replicas_of(self, id: str) -> list[tuple[str, int]]:
+        return self.__ring.nodes_for(id, self.__replicas)
+
+    def add_user(self, user: User):
+        replicas = {id: self.replicas_of(id) for id in user.ids}
+        targets = {node for nodes in replicas.values() for node in nodes}
+        futures = {node: self.__executor.submit(self.__nodes[node].add_user, user) for node in targets}
+        wait(futures.values())
+        try:
+            for id, nodes in replicas.items():
+                errors = [futures[node].exception() for node in nodes if futures[node].exception() is not None]
+                conflicts = [e for e in errors if isinstance(e, RuntimeError)] # i.e. errors raised by servers
+                if conflicts:
+                    raise conflicts[0]
+                if len(nodes) - len(errors) < self.__write_quorum:
+                    raise ConnectionError(f"Only {len(nodes) - len(errors)} replicas out of {len(nodes)} stored ID {id}, while the write quorum is {self.__write_quorum}")
+        except Exception:
+            # replicas which did not fail had none of the IDs, hence they stored this very user
+            stored = [node for node, future in futures.items() if future.exception() is None]
+            wait([self.__executor.submit(self.__nodes[node].remove_user, user.username) for node in stored])
+            raise
+
+    def remove_user(self, id: str) -> User:
+        user = self.get_user(id)
+        targets = {node for other in user.ids for node in self.replicas_of(other)}
+        futures = [self.__executor.submit(self.__nodes[node].remove_user, user.username) for node in targets]
+        wait(futures)
+        errors = [future.exception() for future in futures]
+        if all(errors) and errors[0] is not None:
+            raise errors[0]
+        return user
+
+    def __read(self, id: str, function, missing):
+        """
+        Asks replicas one at a time, until one of them gives a non-missing result.
+        Replicas may miss recent writes, if these were not acknowledged by all replicas.
+        """
+        result = missing
+        error: Exception | None = None
+        for node in self.replicas_of(id):
+            try:
+                result = function(self.__nodes[node])
+                error = None
+                if result is not missing:
+                    return result
+            except OSError as e: # e.g. replica unreachable
+                error = error or e
+            except RuntimeError as e:
+                error = e # e.g. user not found
+        if error is not None:
+            raise error
+        return result
+
+    def get_user(self, id: str) -> User:
+        return self.__read(id, lambda node: node.get_user(id), None)
+
+    def check_password(self, credentials: Credentials) -> bool:
+        return self.__read(credentials.id, lambda node: node.check_password(credentials), False)
+
+    def close(self):
+        self.__executor.shutdown()
+
+
+if __name__ == '__main__':
+    from snippets.lab4.example0_users import gc_user, gc_credentials_ok, gc_credentials_wrong
+    import sys
+
+    if len(sys.argv) < 2:
+        print(f'Usage: python -m snippets -l 4 -e 6 ADDRESS [ADDRESS ...]')
+        sys.exit(1)
+
+    user_db = DistributedUserDatabase([address(arg) for arg in sys.argv[1:]], replicas=2)
+
+    # Adding a novel user should work
+    user_db.add_user(gc_user)
+    for id in gc_user.ids:
+        print('# Replicas of', id, 'are', ', '.join('%s:%d' % node for node in user_db.replicas_of(id)))
+
+    # Trying to add a user that already exist should fail
+    try:
+        user_db.add_user(gc_user)
+    except RuntimeError as e:
+        assert str(e).endswith('already exists')
+
+    # Getting a user that exists should work, no matter which ID is used
+    for id in gc_user.ids:
+        assert user_db.get_user(id) == gc_user.copy(password=None)
+
+    # Checking credentials should work if there exists a user with the same ID and password (no matter which ID is used)
+    for gc_cred in gc_credentials_ok:
+        assert user_db.check_password(gc_cred) == True
+
+    # Checking credentials should fail if the password is wrong
+    assert user_db.check_password(gc_credentials_wrong) == False
+
+    user_db.close()
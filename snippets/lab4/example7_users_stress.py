@@ -0,0 +1,86 @@
+from snippets.lab4.users import *
+from snippets.lab4.users.impl import InMemoryUserDatabase, PasswordHasher
+import random
+import threading
+import time
+
+
+def contender_user(thread: int, i: int) -> User:
+    """
+    All threads compete for the same email addresses, under different usernames:
+    even threads use the same username as well, odd threads use their own.
+    """
+    username = f'user{i}' if thread % 2 == 0 else f'alias{thread}_{i}'
+    return User(username, {f'user{i}@example.com', f'thread{thread}_{i}@example.com'}, password=f'password{thread}')
+
+
+def stress(threads: int = 16, users: int = 1000, readers: int = 4, stripes: int = 64):
+    user_db = InMemoryUserDatabase(debug=False, hasher=PasswordHasher(iterations=1000), stripes=stripes)
+    added = [0] * threads
+    inconsistencies = []
+    writing = True
+
+    def write(thread: int):
+        order = list(range(users))
+        random.shuffle(order)
+        for i in order:
+            try:
+                user_db.add_user(contender_user(thread, i))
+                added[thread] += 1
+            except ValueError:
+                pass # another thread won
+
+    def read():
+        reads = 0
+        while writing:
+            i = random.randrange(users)
+            try:
+                user = user_db.get_user(f'user{i}@example.com')
+            except KeyError:
+                continue
+            reads += 1
+            if f'user{i}@example.com' not in user.emails or user_db.get_user(user.username) != user:
+                inconsistencies.append(user)
+        print(f'# Reader performed {reads} reads')
+
+    writers = [threading.Thread(target=write, args=(t,)) for t in range(threads)]
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    start = time.perf_counter()
+    for thread in writers + reader_threads:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    writing = False
+    for thread in reader_threads:
+        thread.join()
+
+    print(f'# {threads} threads attempted {threads * users} insertions in {elapsed:.2f}s, {sum(added)} succeeded')
+
+    # Each contended email should be owned by exactly one user, which is reachable by all its IDs
+    assert sum(added) == users, f"Expected {users} insertions to succeed, got {sum(added)}"
+    for i in range(users):
+        user = user_db.get_user(f'user{i}@example.com')
+        for id in user.ids:
+            assert user_db.get_user(id) == user
+        winner = next(t for t in range(threads) if contender_user(t, i).ids == user.ids)
+        assert user_db.check_password(Credentials(user.username, f'password{winner}'))
+    assert not inconsistencies, f"Readers observed {len(inconsistencies)} inconsistent users"
+    print('# No ID is shared by two users, and readers never observed inconsistent users')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=f'python -m snippets -l 4 -e 7',
+        description='Stress test of the user database, adding users with conflicting IDs from many threads',
+        exit_on_error=False,
+    )
+    parser.add_argument('--threads', '-t', type=int, default=16, help='Amount of writer threads')
+    parser.add_argument('--users', '-u', type=int, default=1000, help='Amount of users each writer tries to add')
+    parser.add_argument('--readers', '-r', type=int, default=4, help='Amount of reader threads')
+    parser.add_argument('--stripes', '-s', type=int, default=64, help='Amount of lock stripes')
+    args = parser.parse_args()
+
+    stress(args.threads, args.users, args.readers, args.stripes)
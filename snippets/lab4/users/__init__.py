@@ -1,6 +1,7 @@
-from dataclasses import dataclass, replace
+from dataclasses import dataclass, fields
 from datetime import datetime, timedelta
 from enum import Enum
+from functools import cache
 from typing import Protocol
 
 
@@ -11,7 +12,50 @@ class Role(Enum):
 
 class Datum:
     def copy(self, **kwargs):
-        return replace(self, **kwargs)
+        """Copies are never frozen"""
+        values = {field.name: getattr(self, field.name) for field in fields(self) if field.init}
+        return _thawed(type(self))(**(values | kwargs))
+
+    def freeze(self):
+        """
+        Makes this object read-only, so that it can be shared safely.
+        It becomes an instance of a read-only subclass, so that objects which are never frozen pay nothing for it.
+        """
+        object.__setattr__(self, '__class__', _frozen(type(self))) # works on frozen objects, too
+        return self
+
+
+@cache
+def _frozen(cls: type) -> type:
+    if hasattr(cls, '_thawed'):
+        return cls
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Cannot set {name}: {cls.__name__} is frozen")
+
+    def __eq__(self, other): # equal to non-frozen instances with the same fields, as well
+        if not isinstance(other, cls):
+            return NotImplemented
+        return all(getattr(self, field.name) == getattr(other, field.name) for field in fields(cls) if field.compare)
+
+    return type(cls.__name__, (cls,), {
+        '__qualname__': cls.__qualname__,
+        '__module__': cls.__module__,
+        '__setattr__': __setattr__,
+        '__delattr__': __setattr__,
+        '__eq__': __eq__,
+        '__hash__': None,
+        '__reduce__': lambda self: (_refreeze, (self.copy(),)),
+        '_thawed': cls,
+    })
+
+
+def _thawed(cls: type) -> type:
+    return getattr(cls, '_thawed', cls)
+
+
+def _refreeze(datum: Datum) -> Datum:
+    return datum.freeze()
 
 
 @dataclass
@@ -35,6 +79,10 @@ class User(Datum):
     def ids(self):
         return {self.username} | self.emails
 
+    def freeze(self):
+        object.__setattr__(self, 'emails', frozenset(self.emails))
+        return super().freeze()
+
 
 @dataclass
 class Credentials(Datum):
@@ -73,6 +121,9 @@ class UserDatabase(Protocol):
     def check_password(self, credentials: Credentials) -> bool:
         ...
 
+    def remove_user(self, id: str) -> User:
+        ...
+
 
 class AuthenticationService(Protocol):
     def authenticate(self, credentials: Credentials, duration: timedelta = None) -> Token:
@@ -1,57 +1,370 @@
 from ..users import *
+from collections import OrderedDict
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from operator import attrgetter
+from typing import Iterable, Iterator
+import base64
+import bisect
 import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
 
 
-def _compute_sha256_hash(input: str) -> str:
-    sha256_hash = hashlib.sha256()
-    sha256_hash.update(input.encode('utf-8'))
-    return sha256_hash.hexdigest()
+def _pbkdf2(password: bytes, salt: bytes, iterations: int) -> bytes:
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+
+def _scrypt(password: bytes, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024)
+
+
+def _email_domain(email: str) -> str:
+    return email.rpartition('@')[2].lower()
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode('ascii')
+
+
+def _canonical_token_payload(user: User, expiration: datetime) -> bytes:
+    """
+    Unambiguous encoding of all the signed contents of a token: each field is preceded by its length
+    (or by a marker, if absent), and emails are sorted, so that equal tokens are encoded in the same way,
+    no matter how they were built.
+    """
+    fields = [user.username, user.full_name, user.role.name, expiration.isoformat(), *sorted(user.emails)]
+    payload = bytearray()
+    for field in fields:
+        if field is None:
+            payload += _ABSENT_FIELD
+            continue
+        encoded = field.encode('utf-8')
+        payload += len(encoded).to_bytes(4, 'big')
+        payload += encoded
+    return bytes(payload)
+
+
+_ABSENT_FIELD = b'\xff' * 4 # not a valid length, as fields are way shorter
+
+_USERNAME = attrgetter('username')
+
+
+class PasswordHasher:
+    """
+    Salted, deliberately slow password hashing, via either PBKDF2-SHA256 or scrypt, with tunable cost.
+    Digests are strings carrying the algorithm, its cost parameters, and the salt (e.g. `pbkdf2_sha256$100000$salt$hash`),
+    so that they can still be verified after costs are changed.
+    Hashing runs on the given executor, or on the calling thread by default: hashlib releases the GIL while hashing,
+    hence concurrent callers (e.g. requests handled by a thread pool) use all cores either way,
+    while an executor bounds the amount of concurrent hashes (and a process pool can be provided as well).
+    Successful verifications are remembered for `cache_ttl` seconds (up to `cache_size` of them),
+    so that repeated logins do not pay the hashing cost again.
+    """
+
+    ALGORITHMS = ('pbkdf2_sha256', 'scrypt')
+
+    def __init__(self, algorithm: str = 'pbkdf2_sha256', iterations: int = 100_000, n: int = 2**14, r: int = 8, p: int = 1,
+                 executor: Executor = None, cache_size: int = 4096, cache_ttl: float = 60.0):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Unsupported algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.iterations = iterations
+        self.n, self.r, self.p = n, r, p
+        self.__executor = executor # owned by the caller, which shuts it down
+        self.__cache_size = cache_size
+        self.__cache_ttl = cache_ttl
+        self.__cache: OrderedDict[tuple[str, bytes], float] = OrderedDict() # (digest, password fingerprint) -> expiration
+        self.__cache_key = os.urandom(32) # fingerprints are keyed, so that they cannot be reversed offline
+        self.__cache_lock = threading.Lock()
+
+    def __derive(self, password: bytes, salt: bytes, algorithm: str, params: list[int]) -> bytes:
+        if algorithm == 'pbkdf2_sha256':
+            return self.__run(_pbkdf2, password, salt, *params)
+        if algorithm == 'scrypt':
+            return self.__run(_scrypt, password, salt, *params)
+        raise ValueError(f"Unsupported algorithm: {algorithm}")
+
+    def __run(self, function, *args):
+        return function(*args) if self.__executor is None else self.__executor.submit(function, *args).result()
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        params = [self.iterations] if self.algorithm == 'pbkdf2_sha256' else [self.n, self.r, self.p]
+        derived = self.__derive(password.encode('utf-8'), salt, self.algorithm, params)
+        return '$'.join([self.algorithm, *map(str, params), _b64encode(salt), _b64encode(derived)])
+
+    def verify(self, password: str, digest: str) -> bool:
+        fingerprint = hmac.digest(self.__cache_key, password.encode('utf-8'), 'sha256')
+        if self.__is_cached(digest, fingerprint):
+            return True
+        algorithm, *params, salt, expected = digest.split('$')
+        derived = self.__derive(password.encode('utf-8'), base64.b64decode(salt), algorithm, [int(x) for x in params])
+        result = hmac.compare_digest(derived, base64.b64decode(expected))
+        if result:
+            self.__remember(digest, fingerprint)
+        return result
+
+    def __is_cached(self, digest: str, fingerprint: bytes) -> bool:
+        with self.__cache_lock:
+            expiration = self.__cache.get((digest, fingerprint))
+            if expiration is None:
+                return False
+            if expiration < time.monotonic():
+                del self.__cache[(digest, fingerprint)]
+                return False
+            self.__cache.move_to_end((digest, fingerprint))
+            return True
+
+    def __remember(self, digest: str, fingerprint: bytes):
+        with self.__cache_lock:
+            self.__cache[(digest, fingerprint)] = time.monotonic() + self.__cache_ttl
+            self.__cache.move_to_end((digest, fingerprint))
+            while len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+
+
+class _UserRecord:
+    """
+    Compact representation of a stored user: no per-instance dict, emails as a tuple of interned strings,
+    and the password digest split into its (interned, hence shared) scheme, and its raw salt and hash,
+    stored in one bytes object as: salt length, salt, hash.
+    The public view of the user is created upon the first lookup, and then reused.
+    """
+
+    __slots__ = ('username', 'emails', 'full_name', 'role', 'scheme', 'secret', '_view', 'visible')
+
+    def __init__(self, user: User):
+        assert user.password is not None # stored users always have a digest
+        self.username = sys.intern(user.username)
+        self.emails = tuple(sys.intern(email) for email in user.emails)
+        self.full_name = user.full_name
+        self.role = user.role
+        scheme, salt, hash = user.password.rsplit('$', 2)
+        self.scheme = sys.intern(scheme)
+        salt_bytes = base64.b64decode(salt)
+        self.secret = bytes([len(salt_bytes)]) + salt_bytes + base64.b64decode(hash)
+        self._view: User | None = None
+        self.visible = False # set once indexed under all its IDs, and unset before being removed from the index
+
+    @property
+    def ids(self):
+        return (self.username, *self.emails)
+
+    @property
+    def digest(self) -> str:
+        salt_end = 1 + self.secret[0]
+        return f'{self.scheme}${_b64encode(self.secret[1:salt_end])}${_b64encode(self.secret[salt_end:])}'
+
+    def to_user(self, with_password: bool = False) -> User:
+        return User(self.username, set(self.emails), self.full_name, self.role, self.digest if with_password else None)
+
+    @property
+    def view(self) -> User:
+        """Frozen user without password, shared by all lookups"""
+        if self._view is None:
+            self._view = self.to_user().freeze()
+        return self._view
 
 
 class _Debuggable:
     def __init__(self, debug: bool = True):
         self.__debug = debug
     
-    def _log(self, *args, **kwargs):
+    def _log(self, message: str, *args):
+        """Arguments are %-formatted into the message only if debugging is enabled"""
         if self.__debug:
-            print(*args, **kwargs)
+            print(message % args if args else message)
 
 
 class InMemoryUserDatabase(UserDatabase, _Debuggable):
-    def __init__(self, debug: bool = True):
+    """
+    Thread-safe user database.
+    Reads take no lock: users are fully built before being indexed, and single dict or list operations are atomic.
+    Users appear (and disappear) under all their IDs at once: their record is flagged as visible once indexed
+    under all of them, and unflagged before being removed from the index.
+    Writes lock the stripes of all the IDs of the user being added (always in the same order, to avoid deadlocks),
+    hence concurrent writes of users sharing some ID are serialized, while the others are not:
+    this way, checking that IDs are free and inserting the user is atomic, i.e. no ID can end up shared by two users.
+    Secondary indexes are updated under a further lock, held for a few operations at a time.
+    """
+
+    def __init__(self, debug: bool = True, hasher: PasswordHasher = None, stripes: int = 64):
         _Debuggable.__init__(self, debug)
-        self.__users: dict[str, User] = {}
+        self.__hasher = hasher or PasswordHasher()
+        self.__stripes = [threading.Lock() for _ in range(stripes)]
+        self.__lock = threading.Lock() # guards rows allocation and secondary indexes
+        self.__rows: list[_UserRecord | None] = [] # rows of removed users are None, until reused
+        self.__free_rows: list[int] = []
+        self.__index: dict[str, int] = {} # ID -> row, shared by all IDs of the same user
+        self.__by_role: dict[Role, set[int]] = {role: set() for role in Role}
+        self.__by_domain: dict[str, set[int]] = {}
+        self.__usernames: list[str] = [] # sorted lazily, i.e. upon the first prefix search following insertions
+        self.__usernames_sorted = True
+        self.__removed_usernames: set[str] = set() # still in the list above, until the next prefix search
         self._log("User database initialized with empty users")
     
+    @property
+    def hasher(self) -> PasswordHasher:
+        return self.__hasher
+
     def add_user(self, user: User):
-        for id in user.ids:
-            if id in self.__users:
-                raise ValueError(f"User with ID {id} already exists")
+        self.__check_free(user.ids) # fail fast, before hashing
+        if user.password is None:
+            raise ValueError("Password digest is required")
+        self.add_hashed_user(user.copy(password=self.__hasher.hash(user.password)))
+
+    def add_hashed_user(self, user: User):
+        """Same as `add_user`, for users whose password is already hashed (e.g. by another replica)"""
         if user.password is None:
             raise ValueError("Password digest is required")
-        user = user.copy(password=_compute_sha256_hash(user.password))
-        for id in user.ids:
-            self.__users[id] = user
-        self._log(f"Add: {user}")
+        with self.__locked(user.ids):
+            self.__check_free(user.ids) # IDs may have been taken while hashing
+            self._insert(user)
+        self._log("Add: %s", user)
+
+    def remove_user(self, id: str) -> User:
+        """Removes the user with the given ID, under all its IDs, and returns it"""
+        with self.__locked(self.__get_record(id).ids):
+            record = self.__get_record(id) # the user cannot have changed, as the stripe of the given ID is locked
+            self._delete(record.username)
+        self._log("Remove: %s", record.view)
+        return record.view
+
+    @contextmanager
+    def __locked(self, ids: Iterable[str]):
+        """Holds the stripes of the given IDs, acquired always in the same order, to avoid deadlocks"""
+        stripes = [self.__stripes[i] for i in sorted({hash(id) % len(self.__stripes) for id in ids})]
+        for stripe in stripes:
+            stripe.acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                stripe.release()
+
+    def __check_free(self, ids: Iterable[str]):
+        for id in ids:
+            if id in self.__index:
+                raise ValueError(f"User with ID {id} already exists")
+
+    def _insert(self, user: User):
+        """Stores a user whose password is already hashed, replacing whichever users are stored under the same IDs"""
+        record = _UserRecord(user)
+        with self.__lock:
+            for replaced in {self.__index[id] for id in record.ids if id in self.__index}:
+                self.__remove(replaced)
+            if self.__free_rows:
+                row = self.__free_rows.pop()
+                self.__rows[row] = record
+            else:
+                self.__rows.append(record)
+                row = len(self.__rows) - 1
+            for id in record.ids:
+                self.__index[id] = row
+            self.__by_role[record.role].add(row)
+            for email in record.emails:
+                self.__by_domain.setdefault(_email_domain(email), set()).add(row)
+            record.visible = True # publishes the user under all its IDs at once
+            if record.username in self.__removed_usernames:
+                self.__removed_usernames.discard(record.username) # its entry is still in the list
+            else:
+                self.__usernames.append(record.username)
+                self.__usernames_sorted = False
+
+    def _delete(self, id: str):
+        """Removes the user stored under the given ID, if any, under all its IDs"""
+        with self.__lock:
+            row = self.__index.get(id)
+            if row is not None:
+                self.__remove(row)
+
+    def __remove(self, row: int):
+        # the row is freed for reuse, rather than deleted, in order for other rows not to be renumbered
+        record = self.__rows[row]
+        assert record is not None
+        record.visible = False # hides the user under all its IDs at once
+        for id in record.ids:
+            if self.__index.get(id) == row:
+                del self.__index[id]
+        self.__by_role[record.role].discard(row)
+        for email in record.emails:
+            self.__by_domain[_email_domain(email)].discard(row)
+        self.__removed_usernames.add(record.username) # removing it from the list right away would take linear time
+        self.__rows[row] = None
+        self.__free_rows.append(row)
+
+    def _users(self) -> list[User]:
+        """All stored users (along with their digests), each one listed once"""
+        with self.__lock:
+            records = [record for record in self.__rows if record is not None]
+        return [record.to_user(with_password=True) for record in records]
 
-    def __get_user(self, id: str) -> User:
-        if id not in self.__users:
+    def __get_record(self, id: str) -> _UserRecord:
+        row = self.__index.get(id)
+        record = None if row is None else self.__rows[row]
+        # the row may have been reused by another user since the lookup
+        if record is None or not record.visible or id not in record.ids:
             raise KeyError(f"User with ID {id} not found")
-        return self.__users[id]
+        return record
     
     def get_user(self, id: str) -> User:
-        result = self.__get_user(id).copy(password=None)
-        self._log(f"Get user with ID {id}: {result}")
+        """The returned user is frozen and shared: use `copy` to get a modifiable one"""
+        result = self.__get_record(id).view
+        self._log("Get user with ID %s: %s", id, result)
         return result
 
     def check_password(self, credentials: Credentials) -> bool:
         try:
-            user = self.__get_user(credentials.id)
-            result = user.password == _compute_sha256_hash(credentials.password)
+            record = self.__get_record(credentials.id)
+            result = self.__hasher.verify(credentials.password, record.digest)
         except KeyError:
             result = False
-        self._log(f"Checking {credentials}: {'correct' if result else 'incorrect'}")
+        self._log("Checking %s: %s", credentials, 'correct' if result else 'incorrect')
         return result
+
+    def get_users_by_role(self, role: Role, limit: int = None, after: str = None) -> Iterator[User]:
+        """
+        Users with the given role, sorted by username.
+        Results are paginated via `limit` (i.e. the page size) and `after` (i.e. the last username of the previous page).
+        """
+        return self.__query(self.__by_role[role], limit, after)
+
+    def get_users_by_email_domain(self, domain: str, limit: int = None, after: str = None) -> Iterator[User]:
+        """Users with at least one email in the given domain, sorted and paginated as in `get_users_by_role`"""
+        return self.__query(self.__by_domain.get(domain.lower(), ()), limit, after)
+
+    def get_users_by_username_prefix(self, prefix: str, limit: int = None, after: str = None) -> Iterator[User]:
+        """Users whose username starts with the given prefix, sorted and paginated as in `get_users_by_role`"""
+        with self.__lock:
+            if self.__removed_usernames:
+                self.__usernames = [username for username in self.__usernames if username not in self.__removed_usernames]
+                self.__removed_usernames.clear()
+            if not self.__usernames_sorted:
+                self.__usernames.sort() # mostly sorted already, hence fast
+                self.__usernames_sorted = True
+            usernames = self.__usernames
+            start = bisect.bisect_left(usernames, prefix) if after is None else bisect.bisect_right(usernames, max(after, prefix))
+            end = bisect.bisect_left(usernames, prefix + '\U0010ffff') # i.e. past the last string starting with the prefix
+            rows = [self.__index[username] for username in usernames[start:end][:limit]]
+            records = [record for row in rows if (record := self.__rows[row]) is not None] # indexed rows are never freed
+        return self.__users_of(records)
+
+    def __query(self, rows: Iterable[int], limit: int | None, after: str | None) -> Iterator[User]:
+        with self.__lock:
+            records = [record for row in rows if (record := self.__rows[row]) is not None] # indexed rows are never freed
+        records.sort(key=_USERNAME) # records never change, hence they can be sorted without holding the lock
+        if after is not None:
+            records = records[bisect.bisect_right(records, after, key=_USERNAME):]
+        return self.__users_of(records[:limit])
+
+    def __users_of(self, records: list[_UserRecord]) -> Iterator[User]:
+        # records are collected right away, while users are materialized lazily, one at a time
+        self._log("Query matched %d users", len(records))
+        return (record.to_user() for record in records)
     
 
 class InMemoryAuthenticationService(AuthenticationService, _Debuggable):
@@ -61,8 +374,8 @@ class InMemoryAuthenticationService(AuthenticationService, _Debuggable):
         if not secret:
             import uuid
             secret = str(uuid.uuid4())
-        self.__secret = secret
-        self._log(f"Authentication service initialized with secret {secret}")
+        self.__mac = hmac.new(secret.encode('utf-8'), digestmod='sha256') # keyed once, then copied for each token
+        self._log("Authentication service initialized with secret %s", secret)
     
     def authenticate(self, credentials: Credentials, duration: timedelta = None) -> Token:
         if duration is None:
@@ -70,16 +383,21 @@ class InMemoryAuthenticationService(AuthenticationService, _Debuggable):
         if self.__database.check_password(credentials):
             expiration = datetime.now() + duration
             user = self.__database.get_user(credentials.id)
-            signature = _compute_sha256_hash(f"{user}{expiration}{self.__secret}")
-            result = Token(user, expiration, signature)
-            self._log(f"Generate token for user {credentials.id}: {result}")
+            result = Token(user, expiration, self.__sign(user, expiration))
+            self._log("Generate token for user %s: %s", credentials.id, result)
             return result
         raise ValueError("Invalid credentials")
     
+    def __sign(self, user: User, expiration: datetime) -> str:
+        mac = self.__mac.copy()
+        mac.update(_canonical_token_payload(user, expiration))
+        return mac.hexdigest()
+
     def __validate_token_signature(self, token: Token) -> bool:
-        return token.signature == _compute_sha256_hash(f"{token.user}{token.expiration}{self.__secret}")
+        # bytes, as strings with non-ASCII characters (e.g. in forged signatures) cannot be compared
+        return hmac.compare_digest(token.signature.encode('utf-8'), self.__sign(token.user, token.expiration).encode('ascii'))
 
     def validate_token(self, token: Token) -> bool:
         result = token.expiration > datetime.now() and self.__validate_token_signature(token)
-        self._log(f"{token} is " + ('valid' if result else 'invalid'))
+        self._log("%s is %s", token, 'valid' if result else 'invalid')
         return result
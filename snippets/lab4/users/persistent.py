@@ -0,0 +1,345 @@
+from .impl import *
+from pathlib import Path
+import json
+import struct
+import zlib
+
+
+_RECORD_HEADER = struct.Struct('>II') # length and CRC32 of the payload
+
+
+def _encode_record(user: User) -> bytes:
+    payload = json.dumps(
+        [user.username, sorted(user.emails), user.full_name, user.role.name, user.password],
+        separators=(',', ':'),
+    ).encode('utf-8')
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _encode_deletion(id: str) -> bytes:
+    payload = json.dumps([id]).encode('utf-8')
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _decode_records(data: bytes) -> tuple[list[User | str], int]:
+    """
+    Decodes all the records in the given data, stopping at the first incomplete or corrupted one
+    (i.e. a write interrupted by a crash).
+    Returns the users (or the IDs of deleted users), along with the length of the valid prefix of the data.
+    """
+    users: list[User | str] = []
+    start = 0
+    while len(data) - start >= _RECORD_HEADER.size:
+        length, checksum = _RECORD_HEADER.unpack_from(data, start)
+        end = start + _RECORD_HEADER.size + length
+        payload = data[start + _RECORD_HEADER.size:end]
+        if end > len(data) or zlib.crc32(payload) != checksum:
+            break
+        fields = json.loads(payload)
+        if len(fields) == 1:
+            users.append(fields[0]) # deletion
+        else:
+            username, emails, full_name, role, password = fields
+            users.append(User(username, emails, full_name, Role[role], password))
+        start = end
+    return users, start
+
+
+def _fsync_directory(path: Path):
+    if os.name == 'posix': # directories cannot be opened on Windows
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class _Batch:
+    """Records appended while the previous batch was being written: they are synced together, or fail together"""
+
+    __slots__ = ('records', 'count', 'done', 'error')
+
+    def __init__(self):
+        self.records = bytearray()
+        self.count = 0
+        self.done = False
+        self.error: OSError | None = None
+
+
+class PersistentUserDatabase(InMemoryUserDatabase):
+    """
+    An in-memory user database, whose changes are appended to a write-ahead log (WAL) on disk,
+    so that it can be recovered after a restart.
+
+    `add_user` returns once its record is on disk (i.e. fsync-ed).
+    Records are written by a background thread, which syncs all records appended in the meanwhile at once
+    (i.e. group commit): the more concurrent writers, the more records per fsync.
+    Users become visible to readers as soon as they are added, slightly before being on disk,
+    and they are removed again if their records fail to be written.
+    A failed write is cut off the log, so that later records are not appended after a torn one;
+    if the log cannot be cut, all later writes fail.
+
+    Every `snapshot_every` records, the log is rotated, and a snapshot of all users is written in the background:
+    recovery loads the latest snapshot, then replays the log segments following it.
+    Both are sequences of length-prefixed, checksummed records, so that a record torn by a crash is detected and dropped.
+    """
+
+    def __init__(self, directory, debug: bool = True, hasher: PasswordHasher = None,
+                 commit_delay: float = 0.0, snapshot_every: int = 100_000):
+        """
+        The writer thread waits `commit_delay` seconds before each fsync, to gather more records in each.
+        """
+        super().__init__(debug, hasher)
+        self.__directory = Path(directory)
+        self.__directory.mkdir(parents=True, exist_ok=True)
+        self.__commit_delay = commit_delay
+        self.__snapshot_every = snapshot_every
+        self.__condition = threading.Condition()
+        self.__batch = _Batch() # records waiting to be written
+        self.__since_snapshot = 0 # amount of records synced since the last rotation
+        self.__snapshot_requested = False
+        self.__broken: OSError | None = None # set if a failed write could not be cut off the log
+        self.__closed = False
+        self.__segment = self.__recover()
+        self.__open_segment() # the log is only written by the writer thread
+        self.__snapshotting = False # whether a snapshot is being written
+        self.__snapshotter: threading.Thread | None = None
+        self.__writer = threading.Thread(target=self.__write_records, name='wal-writer', daemon=True)
+        self.__writer.start()
+
+    def __segment_path(self, segment: int) -> Path:
+        return self.__directory / f'wal-{segment:08d}.log'
+
+    def __snapshot_path(self, segment: int) -> Path:
+        return self.__directory / f'snapshot-{segment:08d}.dat' # contains all records of previous segments
+
+    @staticmethod
+    def __number(path: Path) -> int:
+        return int(path.stem.split('-')[1])
+
+    def __history(self, end: int = None) -> tuple[Path | None, list[Path]]:
+        """The latest snapshot, and the log segments following it (up to segment `end`, excluded, if given)"""
+        snapshots = sorted(
+            (p for p in self.__directory.glob('snapshot-*.dat') if end is None or self.__number(p) < end),
+            key=self.__number,
+        )
+        first_segment = self.__number(snapshots[-1]) if snapshots else 0
+        segments = [
+            p for p in sorted(self.__directory.glob('wal-*.log'), key=self.__number)
+            if first_segment <= self.__number(p) and (end is None or self.__number(p) < end)
+        ]
+        return (snapshots[-1] if snapshots else None), segments
+
+    def __recover(self) -> int:
+        """Loads the latest snapshot and replays the following log segments, returning the segment to append to"""
+        snapshot, segments = self.__history()
+        first_segment = self.__number(snapshot) if snapshot else 0
+        recovered = 0
+        if snapshot:
+            users, _ = _decode_records(snapshot.read_bytes())
+            self.__replay(users)
+            recovered += len(users)
+        for path in segments:
+            data = path.read_bytes()
+            users, valid = _decode_records(data)
+            self.__replay(users)
+            recovered += len(users)
+            if valid < len(data):
+                self._log("Dropping %d bytes of incomplete records from %s", len(data) - valid, path.name)
+                with open(path, 'r+b') as file:
+                    file.truncate(valid)
+        self.__delete_before(first_segment)
+        for path in self.__directory.glob('snapshot-*.tmp'): # left by a crash while writing a snapshot
+            path.unlink()
+        self._log("Recovered %d records from %s", recovered, self.__directory)
+        return self.__number(segments[-1]) if segments else first_segment
+
+    def __replay(self, records: list[User | str], database: InMemoryUserDatabase = None):
+        """Applies the given records to this database (without logging them again), or to the given one"""
+        insert = super()._insert if database is None else database._insert
+        delete = super()._delete if database is None else database._delete
+        for record in records:
+            if isinstance(record, str):
+                delete(record)
+            else:
+                insert(record)
+
+    def __delete_before(self, segment: int):
+        for path in [*self.__directory.glob('wal-*.log'), *self.__directory.glob('snapshot-*.dat')]:
+            if self.__number(path) < segment:
+                path.unlink()
+
+    def __open_segment(self):
+        # unbuffered, so that nothing is left to be written after a failed write is cut off
+        self.__log = open(self.__segment_path(self.__segment), 'ab', buffering=0)
+        self.__offset = os.fstat(self.__log.fileno()).st_size # end of the last complete record
+
+    def _insert(self, user: User):
+        super()._insert(user)
+        try:
+            self.__append(_encode_record(user))
+        except BaseException:
+            super()._delete(user.username) # not durable, hence not stored
+            raise
+
+    def _delete(self, id: str):
+        self.__append(_encode_deletion(id)) # the user is stored until the deletion is on disk
+        super()._delete(id)
+
+    def __append(self, record: bytes):
+        with self.__condition:
+            if self.__closed:
+                raise ValueError("Database is closed")
+            if self.__broken is not None:
+                raise OSError(f"Log is unusable after a failed write: {self.__broken}")
+            batch = self.__batch
+            batch.records += record
+            batch.count += 1
+            self.__condition.notify_all()
+            while not batch.done:
+                self.__condition.wait()
+            if batch.error is not None:
+                raise OSError(f"Failed to persist user: {batch.error}")
+
+    def snapshot(self):
+        """Asks for a snapshot to be written as soon as possible, without waiting for `snapshot_every` records"""
+        with self.__condition:
+            self.__snapshot_requested = True
+            self.__condition.notify_all()
+
+    def __write_records(self):
+        while True:
+            with self.__condition:
+                while not self.__batch.count and not self.__closed and not self.__rotation_due():
+                    self.__condition.wait()
+                if not self.__batch.count and self.__closed:
+                    return
+            if self.__batch.count:
+                self.__sync()
+            with self.__condition:
+                rotate = self.__rotation_due()
+                if rotate:
+                    self.__snapshot_requested = False
+                    self.__since_snapshot = 0
+                    self.__snapshotting = True
+            if rotate:
+                try:
+                    self.__rotate()
+                except OSError as e: # e.g. the new segment cannot be created: nothing can be logged anymore
+                    with self.__condition:
+                        self.__broken = e
+                        self.__snapshotting = False
+                        self.__condition.notify_all()
+
+    def __rotation_due(self) -> bool:
+        # one snapshot at a time, and none once the log is unusable
+        return not self.__snapshotting and self.__broken is None and (self.__snapshot_requested or self.__since_snapshot >= self.__snapshot_every)
+
+    def __sync(self):
+        if self.__commit_delay:
+            time.sleep(self.__commit_delay)
+        with self.__condition:
+            batch, self.__batch = self.__batch, _Batch()
+            batch.error = self.__broken # records appended before the log became unusable fail as well
+        if batch.error is None:
+            try:
+                with memoryview(batch.records) as view:
+                    while view: # raw writes may be partial
+                        view = view[self.__log.write(view):]
+                os.fsync(self.__log.fileno())
+                self.__offset += len(batch.records)
+            except OSError as e:
+                batch.error = e
+                self.__cut()
+        with self.__condition:
+            batch.done = True
+            if batch.error is None:
+                self.__since_snapshot += batch.count
+            self.__condition.notify_all()
+
+    def __cut(self):
+        """Removes whatever part of a failed write reached the log"""
+        try:
+            os.ftruncate(self.__log.fileno(), self.__offset)
+            os.fsync(self.__log.fileno())
+        except OSError as e:
+            with self.__condition:
+                self.__broken = e
+
+    def __rotate(self):
+        """Starts a new log segment, and writes a snapshot covering previous ones in the background"""
+        self.__log.close()
+        self.__segment += 1
+        self.__open_segment()
+        _fsync_directory(self.__directory)
+        self.__snapshotter = threading.Thread(target=self.__write_snapshot, args=(self.__segment,), name='wal-snapshot', daemon=True)
+        self.__snapshotter.start()
+
+    def __write_snapshot(self, segment: int):
+        """
+        Compacts the previous snapshot and the log segments before the given one into a new snapshot.
+        They are replayed as recovery would, rather than copying users from memory, which may be ahead of the log
+        (e.g. a user being removed is still in memory, but its deletion may be in the log already)
+        or hold users which are not durable yet, and may be rolled back.
+        """
+        path = self.__snapshot_path(segment)
+        temporary = path.with_suffix('.tmp')
+        try:
+            state = InMemoryUserDatabase(debug=False)
+            snapshot, segments = self.__history(segment)
+            for source in ([snapshot] if snapshot else []) + segments:
+                self.__replay(_decode_records(source.read_bytes())[0], state)
+            users = state._users()
+            with open(temporary, 'wb') as file:
+                file.write(b''.join(_encode_record(user) for user in users))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, path) # snapshots are either complete or missing
+            _fsync_directory(self.__directory)
+            self.__delete_before(segment)
+            self._log("Snapshot of %d users written to %s", len(users), path.name)
+        finally:
+            with self.__condition:
+                self.__snapshotting = False
+                self.__condition.notify_all()
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__writer.join()
+        if self.__snapshotter is not None:
+            self.__snapshotter.join()
+        self.__log.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    class _SlowInMemoryDelete(InMemoryUserDatabase):
+        """Snapshots the database while a deletion is in the log, but not applied in memory yet"""
+
+        def _delete(self, id: str):
+            self.snapshot() # type: ignore[attr-defined]
+            time.sleep(0.5)
+            super()._delete(id)
+
+    class _Racy(PersistentUserDatabase, _SlowInMemoryDelete):
+        pass
+
+    with tempfile.TemporaryDirectory() as directory:
+        user_db = _Racy(directory, debug=False)
+        user_db.add_user(User('alice', {'alice@example.com'}, password='secret'))
+        user_db.add_user(User('bob', {'bob@example.com'}, password='secret'))
+        user_db.remove_user('alice')
+        user_db.close()
+        assert len(list(Path(directory).glob('snapshot-*.dat'))) == 1
+        reopened = PersistentUserDatabase(directory, debug=False)
+        assert reopened.get_user('bob').username == 'bob'
+        try:
+            reopened.get_user('alice')
+            assert False, "Removed user recovered from the snapshot"
+        except KeyError:
+            pass
+        reopened.close()
+    print('Removed users stay removed after snapshots and restarts')